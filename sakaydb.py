@@ -1,8 +1,273 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
+import io
+import json
 import os
-from datetime import datetime
+import sqlite3
+import struct
+import sys
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+
+DATETIME_FORMAT = '%H:%M:%S,%d-%m-%Y'
+
+# Sortable format of the datetimes stored by the sqlite backend
+ISO_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Fixed-width fields of the directives in the datetime formats
+DATETIME_FIELDS = [('%Y', 'YYYY'), ('%m', 'mm'), ('%d', 'dd'),
+                   ('%H', 'HH'), ('%M', 'MM'), ('%S', 'SS')]
+
+# Normal quantile used for the error bounds of approximate results
+Z_95 = 1.96
+
+WEEK = ['Monday', 'Tuesday', 'Wednesday', 'Thursday',
+        'Friday', 'Saturday', 'Sunday']
+
+# Compact in-memory schema of the read-only analytic paths, applied
+# by _downcast. Columns with values that do not fit keep the dtype
+# they are read with. Rows written back by add_trip and delete_trip
+# are read as written so they keep their csv representation.
+TRIPS_KEY_DTYPES = {'trip_id': 'int32',
+                    'driver_id': 'int32',
+                    'passenger_count': 'int8',
+                    'pickup_loc_id': 'int32',
+                    'dropoff_loc_id': 'int32'}
+TRIPS_METRIC_DTYPES = {'trip_distance': 'float32',
+                       'fare_amount': 'float32'}
+DRIVERS_DTYPES = {'driver_id': 'int32'}
+LOCATIONS_DTYPES = {'location_id': 'int32'}
+
+CSV_NAMES = ['trips.csv', 'drivers.csv', 'locations.csv']
+
+# Columns that identify a trip, as add_trip compares them
+TRIP_IDENTITY = ['driver_id', 'pickup_datetime', 'dropoff_datetime',
+                 'passenger_count', 'pickup_loc_id', 'dropoff_loc_id',
+                 'trip_distance', 'fare_amount']
+
+# Rows read at a time when trips.csv is scanned in chunks
+CHUNK_SIZE = 100000
+
+# Keyword arguments of add_trip
+TRIP_FIELDS = ['driver', 'pickup_datetime', 'dropoff_datetime',
+               'passenger_count', 'pickup_loc_name', 'dropoff_loc_name',
+               'trip_distance', 'fare_amount']
+
+# Codes returned by SakayDB.validate_trips, which index TRIP_ERRORS
+TRIP_OK = 0
+TRIP_MISSING = 1
+TRIP_BAD_DRIVER = 2
+TRIP_BAD_LOCATION = 3
+TRIP_BAD_DATETIME = 4
+TRIP_BAD_ORDER = 5
+TRIP_BAD_AMOUNT = 6
+TRIP_BAD_PASSENGERS = 7
+TRIP_DUPLICATE = 8
+TRIP_ERRORS = ['valid',
+               'missing or unexpected fields',
+               'driver is not of the form Last name, Given name',
+               'location is not a name',
+               'datetime is not of the form ' + DATETIME_FORMAT,
+               'dropoff is before pickup',
+               'distance or fare is not a non-negative number',
+               'passenger count is not a non-negative integer',
+               'already in the database']
+
+EXPORT_COLUMNS = ['dropoff_loc_name', 'passenger_count', 'trip_distance',
+                  'dropoff_datetime', 'fare_amount', 'driver_lastname',
+                  'pickup_loc_name', 'driver_givenname', 'pickup_datetime']
+
+
+def _parse_datetimes(values, format=DATETIME_FORMAT):
+    """
+    Parses datetime strings of a fixed-width format such as
+    DATETIME_FORMAT or ISO_FORMAT in bulk, by slicing the digits
+    of all the strings at once as a NumPy array of characters.
+    Strings that are not zero-padded fall back to pd.to_datetime.
+
+    Parameters
+    ----------
+    values : array-like
+        Datetime strings; missing and malformed values are allowed.
+    format : str
+        Format made of the directives in DATETIME_FIELDS and
+        separator characters.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        The parsed datetime64[ns] values, NaT where a value is
+        missing or malformed, and the mask of the values that
+        parsed.
+    """
+    template = format
+    for directive, field in DATETIME_FIELDS:
+        template = template.replace(directive, field)
+    width = len(template)
+    values = np.asarray(values, dtype=object)
+
+    # One code point per column; the extra column is zero only for
+    # strings no longer than the format, and digits outside 0-9
+    # wrap around as unsigned
+    chars = (np.array(values, dtype=f'U{width + 1}').view(np.uint32)
+             .reshape(len(values), width + 1))
+    digits = chars[:, :width] - ord('0')
+    ok = chars[:, width] == 0
+    for i, char in enumerate(template):
+        if char in 'YmdHMS':
+            ok &= digits[:, i] <= 9
+        else:
+            ok &= chars[:, i] == ord(char)
+
+    fields = {}
+    for char in 'YmdHMS':
+        start = template.index(char)
+        n = template.count(char)
+        fields[char] = (digits[:, start:start + n].astype(np.int64)
+                        @ 10 ** np.arange(n - 1, -1, -1))
+    # Years fully inside the range of datetime64[ns]
+    ok &= ((fields['Y'] >= 1678) & (fields['Y'] <= 2261)
+           & (fields['m'] >= 1) & (fields['m'] <= 12)
+           & (fields['H'] < 24) & (fields['M'] < 60) & (fields['S'] < 60))
+    months = np.where(ok, (fields['Y'] - 1970) * 12 + fields['m'] - 1, 0)
+    months = months.astype('datetime64[M]')
+    days = months.astype('datetime64[D]')
+    ok &= ((fields['d'] >= 1)
+           & (fields['d'] <= ((months + 1).astype('datetime64[D]')
+                              - days).astype(np.int64)))
+    seconds = np.where(ok, ((fields['d'] - 1) * 86400
+                            + fields['H'] * 3600 + fields['M'] * 60
+                            + fields['S']), 0)
+    parsed = (days.astype('datetime64[s]') + seconds).astype('datetime64[ns]')
+    parsed[~ok] = np.datetime64('NaT')
+
+    retry = ~ok & ~pd.isna(values)
+    if retry.any():
+        again = pd.to_datetime(pd.Series(values[retry]), format=format,
+                               errors='coerce')
+        parsed[retry] = again.to_numpy()
+        ok[retry] = again.notna().to_numpy()
+    return parsed, ok
+
+
+def _parse_datetime(value, format=DATETIME_FORMAT):
+    """Parses one datetime string with _parse_datetimes, returning
+    NaT if it is malformed."""
+    values = np.empty(1, dtype=object)
+    values[0] = value
+    parsed, ok = _parse_datetimes(values, format)
+    return pd.Timestamp(parsed[0]) if ok[0] else pd.NaT
+
+
+def _downcast(df, dtypes):
+    """Narrows the columns of df to dtypes, leaving integer columns
+    as read unless every value fits, so that no value wraps, and
+    leaving non-numeric columns as read."""
+    narrowed = {}
+    for col, dtype in dtypes.items():
+        if col not in df.columns:
+            continue
+        dtype = np.dtype(dtype)
+        values = df[col].values
+        if dtype.kind == 'f' and values.dtype.kind in 'iuf':
+            narrowed[col] = dtype
+        elif dtype.kind == 'i' and values.dtype.kind in 'iu':
+            info = np.iinfo(dtype)
+            if len(values) == 0 or (info.min <= values.min()
+                                    and values.max() <= info.max):
+                narrowed[col] = dtype
+    return df.astype(narrowed) if narrowed else df
+
+
+def _fingerprints(trips):
+    """64-bit hashes of the TRIP_IDENTITY columns of trips. Numbers
+    are hashed as floats so that 2 and 2.0 match, as they do in
+    add_trip's comparison; values that are equal there always hash
+    the same."""
+    identity = {}
+    for col in TRIP_IDENTITY:
+        if col in ['pickup_datetime', 'dropoff_datetime']:
+            identity[col] = trips[col].astype(str)
+        else:
+            identity[col] = pd.to_numeric(
+                trips[col], errors='coerce').astype(np.float64)
+    return pd.util.hash_pandas_object(pd.DataFrame(identity),
+                                      index=False).values
+
+
+def _sorted_contains(found, values):
+    """Whether each of values is in the sorted array found."""
+    if len(found) == 0:
+        return np.zeros(len(values), dtype=bool)
+    pos = np.minimum(np.searchsorted(found, values), len(found) - 1)
+    return found[pos] == values
+
+
+def _instances(values, types):
+    """Mask of the values that are instances of types, checking
+    each distinct type once rather than each value."""
+    kinds = pd.Series(values, dtype=object).map(type)
+    return kinds.isin([kind for kind in pd.unique(kinds)
+                       if issubclass(kind, types)]).values
+
+
+def _trip_codes(names, columns):
+    """
+    Checks trips as columns, the checks that validate_trips and
+    import_file share: the form of the driver names, location
+    names and datetimes, dropoff not before pickup, non-negative
+    distances and fares, and non-negative whole passenger counts.
+
+    Parameters
+    ----------
+    names : pandas.Series
+        Driver names split into last name and given name.
+    columns : dict
+        Location names and datetimes as strings, NaN where not a
+        string, and passenger_count, trip_distance and fare_amount
+        as numbers, NaN where not a number.
+
+    Returns
+    -------
+    numpy.ndarray
+        int8 code of each trip: TRIP_OK, or the code of its first
+        error.
+    """
+    codes = np.zeros(len(names), dtype=np.int8)
+
+    def flag(bad, code):
+        codes[(codes == TRIP_OK) & bad] = code
+
+    flag(~names.map(lambda parts: isinstance(parts, list)
+                    and len(parts) > 1 and bool(parts[0])
+                    and bool(parts[1])).values.astype(bool),
+         TRIP_BAD_DRIVER)
+    for col in ['pickup_loc_name', 'dropoff_loc_name']:
+        flag(~(columns[col].fillna('').str.strip().str.len() > 0).values,
+             TRIP_BAD_LOCATION)
+
+    pickup, pickup_ok = _parse_datetimes(columns['pickup_datetime'])
+    dropoff, dropoff_ok = _parse_datetimes(columns['dropoff_datetime'])
+    flag(~(pickup_ok & dropoff_ok), TRIP_BAD_DATETIME)
+    flag(dropoff < pickup, TRIP_BAD_ORDER)
+
+    flag(~((columns['trip_distance'] >= 0)
+           & (columns['fare_amount'] >= 0)).values, TRIP_BAD_AMOUNT)
+    flag(~((columns['passenger_count'] >= 0)
+           & (columns['passenger_count'] % 1 == 0)).values,
+         TRIP_BAD_PASSENGERS)
+    return codes
+
+
+def _as_category(keys, lookup):
+    """Maps integer ids onto the names in lookup, a Series of
+    names indexed by id, as a categorical so that each name is
+    stored once. Ids missing from lookup become NaN."""
+    labels = pd.Categorical(lookup.values)
+    pos = lookup.index.get_indexer(keys)
+    codes = np.where(pos >= 0, labels.codes[pos], -1)
+    return pd.Categorical.from_codes(codes, labels.categories)
 
 
 class SakayDBError(ValueError):
@@ -12,12 +277,1295 @@ class SakayDBError(ValueError):
         super().__init__(self.message)
 
 
+class _ResultCache():
+    """
+    Least recently used cache of query results. Entries are tagged
+    with the data version they were computed against and are all
+    dropped as soon as a different version is seen.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of cached results. 0 disables the cache.
+    maxbytes : int, optional
+        Maximum total memory of the cached results in bytes.
+    """
+
+    def __init__(self, maxsize=128, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.version = None
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _copy(result):
+        """Defensive copy so callers cannot mutate cached results."""
+        if isinstance(result, (pd.DataFrame, pd.Series)):
+            return result.copy()
+        elif isinstance(result, (list, tuple)):
+            return type(result)(_ResultCache._copy(r) for r in result)
+        elif isinstance(result, dict):
+            return {k: _ResultCache._copy(v) for k, v in result.items()}
+        return result
+
+    @staticmethod
+    def _sizeof(result):
+        if isinstance(result, pd.DataFrame):
+            return int(result.memory_usage(index=True, deep=True).sum())
+        elif isinstance(result, pd.Series):
+            return int(result.memory_usage(index=True, deep=True))
+        elif isinstance(result, (list, tuple)):
+            return sum(_ResultCache._sizeof(r) for r in result)
+        elif isinstance(result, dict):
+            return sum(_ResultCache._sizeof(v) for v in result.values())
+        return 0
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def get(self, key, version, compute):
+        """Returns a copy of the cached result for key, calling
+        compute to fill the cache on a miss."""
+        if version != self.version:
+            self.clear()
+            self.version = version
+        try:
+            hash(key)
+        except TypeError:
+            key = None
+        if key is not None and key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self._copy(self.entries[key][0])
+
+        self.misses += 1
+        result = compute()
+        if key is None or self.maxsize <= 0:
+            return result
+        size = self._sizeof(result)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return result
+        self.entries[key] = (result, size)
+        self.nbytes += size
+        while (len(self.entries) > self.maxsize or
+               (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+            _, (_, old_size) = self.entries.popitem(last=False)
+            self.nbytes -= old_size
+        return self._copy(result)
+
+    def info(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'maxsize': self.maxsize,
+                'maxbytes': self.maxbytes}
+
+
+class _DaySample():
+    """
+    Stratified sample of the trips that keeps at most k trips per
+    pickup day by reservoir sampling, together with the exact
+    number of trips on every day. Estimates drawn from it cost
+    time proportional to the number of days, not of trips.
+
+    Parameters
+    ----------
+    trips : data frame
+        Trips with the columns in _DaySample.COLUMNS.
+    k : int
+        Maximum number of sampled trips per day.
+    version
+        Data version the sample was drawn from.
+    """
+
+    COLUMNS = ['pickup_datetime', 'dropoff_datetime', 'driver_id',
+               'passenger_count', 'pickup_loc_id', 'dropoff_loc_id']
+
+    def __init__(self, trips, k, version, seed=None):
+        self.k = k
+        self.version = version
+        self.rng = np.random.default_rng(seed)
+        date = trips['pickup_datetime'].dt.floor('D')
+        self.day_counts = date.value_counts().sort_index()
+        # Keeping the k smallest random keys of each day is a
+        # uniform sample without replacement within the day
+        rank = (pd.Series(self.rng.random(len(trips)), index=trips.index)
+                .groupby(date).rank(method='first'))
+        keep = (rank <= k).values
+        self.sample = (trips.loc[keep, self.COLUMNS]
+                       .assign(date=date[keep])
+                       .reset_index(drop=True))
+
+    def add(self, row):
+        """Adds one trip, keeping each day's sample uniform."""
+        date = row['pickup_datetime'].floor('D')
+        n = self.day_counts.get(date, 0) + 1
+        self.day_counts.loc[date] = n
+        row = pd.DataFrame([dict(row, date=date)])[self.sample.columns]
+        if n <= self.k:
+            self.sample = pd.concat([self.sample, row], ignore_index=True)
+        else:
+            j = self.rng.integers(n)
+            if j < self.k:
+                pos = np.flatnonzero(self.sample['date'].values
+                                     == np.datetime64(date))[j]
+                self.sample.loc[pos] = row.iloc[0]
+
+    def daily_estimates(self, keys, rows=None):
+        """
+        Estimated number of trips per day for each combination of
+        keys, with the variance of each estimate.
+
+        Parameters
+        ----------
+        keys : dict
+            Columns aligned with the sample to group by.
+        rows : array of bool, optional
+            Restricts the estimate to the sampled trips selected.
+
+        Returns
+        -------
+        data frame
+            One row per keys and date with columns est and var, and
+            whole for the days that were kept whole.
+        """
+        frame = pd.DataFrame(keys, index=self.sample.index)
+        frame['date'] = self.sample['date']
+        if rows is not None:
+            frame = frame.loc[rows]
+        counts = (frame.groupby(list(keys) + ['date'], observed=True)
+                  .size().rename('c').reset_index())
+        n = self.day_counts.reindex(counts['date']).values.astype(float)
+        s = np.minimum(n, self.k)
+        p = counts['c'].values / s
+        # No sampling error on days that were kept whole
+        fpc = np.where(n > 1, (n - s) / np.maximum(n - 1, 1), 0)
+        counts['est'] = n * p
+        counts['var'] = n ** 2 * p * (1 - p) / s * fpc
+        counts['whole'] = n <= self.k
+        return counts
+
+
+class _DriverCounts():
+    """
+    Number of trips and of days with trips of every driver on
+    each day of week. Kept up to date as trips are added, so
+    driver rankings need neither a rescan nor a full sort.
+
+    Parameters
+    ----------
+    trips : data frame
+        Trips with driver_id and pickup_datetime columns.
+    version
+        Data version the counts were taken from.
+    """
+
+    def __init__(self, trips, version):
+        self.version = version
+        date = trips['pickup_datetime'].dt.floor('D')
+        daily = trips.groupby([trips['driver_id'], date]).size()
+        ids = daily.index.get_level_values(0)
+        dates = daily.index.get_level_values(1)
+        self.ids = pd.Index(np.unique(ids))
+        self.trips = np.zeros((len(self.ids), len(WEEK)), dtype=np.int64)
+        self.days = np.zeros((len(self.ids), len(WEEK)), dtype=np.int64)
+        at = (self.ids.get_indexer(ids), dates.dayofweek)
+        np.add.at(self.trips, at, daily.values)
+        np.add.at(self.days, at, 1)
+        # Driver and day pairs seen, to tell if a new trip adds a day
+        self.active = set(zip(ids.tolist(), dates.tolist()))
+
+    def add(self, row):
+        """Counts one more trip."""
+        driver_id = row['driver_id']
+        date = row['pickup_datetime'].floor('D')
+        if driver_id not in self.ids:
+            self.ids = self.ids.append(pd.Index([driver_id]))
+            self.trips = np.vstack([self.trips, np.zeros((1, len(WEEK)),
+                                                         dtype=np.int64)])
+            self.days = np.vstack([self.days, np.zeros((1, len(WEEK)),
+                                                       dtype=np.int64)])
+        at = (self.ids.get_loc(driver_id), date.dayofweek)
+        self.trips[at] += 1
+        if (driver_id, date) not in self.active:
+            self.active.add((driver_id, date))
+            self.days[at] += 1
+
+    def values(self, metric):
+        """Metric per driver and day of week, NaN on days of week
+        without trips."""
+        if metric == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.where(self.days > 0, self.trips / self.days,
+                                np.nan)
+        return np.where(self.trips > 0, self.trips, np.nan)
+
+    def by_name(self, names):
+        """Counts with the drivers that share a display name counted
+        as one, as generate_statistics counts them. names are the
+        display names of ids; the result is indexed by name."""
+        labels, at = np.unique(names, return_inverse=True)
+        if len(labels) == len(names):
+            merged = _DriverCounts.__new__(_DriverCounts)
+            merged.__dict__.update(self.__dict__, ids=pd.Index(names))
+            return merged
+        merged = _DriverCounts.__new__(_DriverCounts)
+        merged.version = self.version
+        merged.ids = pd.Index(labels)
+        merged.trips = np.zeros((len(labels), len(WEEK)), dtype=np.int64)
+        merged.days = np.zeros((len(labels), len(WEEK)), dtype=np.int64)
+        np.add.at(merged.trips, at, self.trips)
+        # A day counts once per name however many of its drivers had
+        # trips on it
+        name_of = dict(zip(self.ids.tolist(), at.tolist()))
+        merged.active = {(name_of[driver_id], date)
+                         for driver_id, date in self.active}
+        rows = [row for row, _ in merged.active]
+        dates = pd.DatetimeIndex([date for _, date in merged.active])
+        np.add.at(merged.days, (rows, dates.dayofweek), 1)
+        return merged
+
+
+class _DriverNames():
+    """
+    Display names and normalized keys of the drivers, built once
+    per driver rather than once per trip and shared by the
+    statistics, the plots and add_trip. The names are interned so
+    the categoricals and lookups built from them share one copy of
+    each. Kept up to date as add_trip adds drivers.
+
+    Keys join the lowercased names with a unit separator, as
+    pandas drops NUL characters from strings.
+
+    Parameters
+    ----------
+    drivers : data frame
+        Drivers with driver_id, given_name and last_name columns.
+    version
+        Data version the drivers were read at.
+    """
+
+    def __init__(self, drivers, version):
+        self.version = version
+        ids = drivers['driver_id'].values
+        given_name = drivers['given_name']
+        last_name = drivers['last_name']
+        # Last, Given in title case, as the statistics show them
+        self.names = self._interned(
+            last_name.str.title() + ', ' + given_name.str.title(), ids)
+        # Given Last as entered, as the driver plot shows them
+        self.full_names = self._interned(given_name + ' ' + last_name, ids)
+        # Case insensitive keys, mapped to the first driver with each
+        keys = self._interned(self.keys(last_name, given_name), ids)
+        self.lookup = dict(zip(keys.values[::-1], ids[::-1].tolist()))
+
+    @staticmethod
+    def key(last_name, given_name):
+        """Normalized key of a driver's names."""
+        return last_name.lower() + '\x1f' + given_name.lower()
+
+    @staticmethod
+    def keys(last_name, given_name):
+        """Normalized keys of Series of driver names."""
+        return last_name.str.lower() + '\x1f' + given_name.str.lower()
+
+    @staticmethod
+    def _interned(names, ids):
+        """names interned and indexed by driver_id."""
+        names = names.map(sys.intern, na_action='ignore')
+        return pd.Series(names.values, index=pd.Index(ids, name='driver_id'))
+
+    def add(self, driver_id, given_name, last_name):
+        """Adds a new driver."""
+        if driver_id in self.names.index:
+            return
+        new = pd.DataFrame({'driver_id': [driver_id],
+                            'given_name': [given_name],
+                            'last_name': [last_name]})
+        added = _DriverNames(new, self.version)
+        self.names = pd.concat([self.names, added.names])
+        self.full_names = pd.concat([self.full_names, added.full_names])
+        for key, value in added.lookup.items():
+            self.lookup.setdefault(key, value)
+
+
+class _DayCounts():
+    """
+    Exact number of trips on every day, in total and by passenger
+    count, driver and pickup-dropoff pair. Added trips are counted
+    in place and the windows over the counts are kept in step.
+
+    Parameters
+    ----------
+    trips : data frame
+        Trips with the columns in _DaySample.COLUMNS.
+    version
+        Data version the counts were taken from.
+    """
+
+    KEYS = {'passenger': ['passenger_count'],
+            'driver': ['driver_id'],
+            'od': ['pickup_loc_id', 'dropoff_loc_id']}
+
+    def __init__(self, trips, version):
+        self.version = version
+        self.windows = {}
+        date = trips['pickup_datetime'].dt.floor('D')
+        self.days = {d: {'trip': n} for d, n in date.value_counts().items()}
+        for kind, cols in self.KEYS.items():
+            counts = trips.groupby([date] + [trips[c] for c in cols]).size()
+            for d, day in counts.groupby(level=0):
+                self.days[d][kind] = day.droplevel(0).to_dict()
+
+    def add(self, row):
+        """Counts one more trip."""
+        date = row['pickup_datetime'].floor('D')
+        windows = [w for w in self.windows.values() if date in w]
+        for window in windows:
+            window.apply(date, -1)
+        day = self.days.setdefault(date, dict({'trip': 0},
+                                              **{k: {} for k in self.KEYS}))
+        day['trip'] += 1
+        for kind, cols in self.KEYS.items():
+            if len(cols) > 1:
+                key = tuple(row[c] for c in cols)
+            else:
+                key = row[cols[0]]
+            day[kind][key] = day[kind].get(key, 0) + 1
+        for window in windows:
+            window.apply(date, 1)
+
+    def window(self, length):
+        """Returns the window of length days over the counts."""
+        if length not in self.windows:
+            self.windows[length] = _Window(self, length)
+        return self.windows[length]
+
+
+class _Window():
+    """
+    Running sums of the day counts over the last length days up to
+    end. The days in the window are kept in a ring buffer, so moving
+    the window forward adds the newest days and evicts the oldest
+    ones instead of summing the whole window again.
+
+    Sums are keyed by key and day of week, except for od pairs which
+    are averaged over all days.
+    """
+
+    def __init__(self, counts, length):
+        self.counts = counts
+        self.length = length
+        self.dates = deque()
+        self.end = None
+        self.trips = {}
+        self.active = {}
+
+    def __contains__(self, date):
+        return bool(self.dates) and self.dates[0] <= date <= self.dates[-1]
+
+    def apply(self, date, sign):
+        """Adds (sign 1) or evicts (sign -1) the counts of a day."""
+        day = self.counts.days.get(date)
+        if day is None:
+            return
+        for kind in ['trip'] + list(_DayCounts.KEYS):
+            trips = self.trips.setdefault(kind, {})
+            active = self.active.setdefault(kind, {})
+            if kind == 'trip':
+                items = [(None, day['trip'])]
+            else:
+                items = day[kind].items()
+            for key, n in items:
+                k = key if kind == 'od' else (key, date.dayofweek)
+                trips[k] = trips.get(k, 0) + sign * n
+                active[k] = active.get(k, 0) + sign
+                if active[k] == 0:
+                    del trips[k], active[k]
+
+    def advance(self, end):
+        """Moves the window so that its last day is end."""
+        start = end - pd.Timedelta(days=self.length - 1)
+        if self.end is None or end < self.end or start > self.end:
+            self.dates.clear()
+            self.trips = {}
+            self.active = {}
+            new = pd.date_range(start, end)
+        else:
+            new = pd.date_range(self.end + pd.Timedelta(days=1), end)
+        for date in new:
+            self.apply(date, 1)
+            self.dates.append(date)
+        while self.dates and self.dates[0] < start:
+            self.apply(self.dates.popleft(), -1)
+        self.end = end
+
+    def means(self, kind):
+        """Average number of trips per day with trips, keyed as the
+        running sums are."""
+        trips = self.trips.get(kind, {})
+        active = self.active.get(kind, {})
+        return {k: n / active[k] for k, n in trips.items()}
+
+
+class _ChunkCounts():
+    """
+    Number of trips per day, in total and by passenger count,
+    driver and pickup-dropoff pair, summed over chunks of trips so
+    that memory is bounded by the number of distinct keys and days
+    instead of the number of trips.
+
+    Parameters
+    ----------
+    kinds : list
+        Counts to keep: 'trip' or keys of _DayCounts.KEYS.
+    """
+
+    def __init__(self, kinds):
+        self.counts = {kind: None for kind in kinds}
+
+    def add(self, trips):
+        """Adds the counts of a chunk of trips."""
+        date = trips['pickup_datetime'].dt.floor('D').rename('date')
+        for kind, counts in self.counts.items():
+            cols = _DayCounts.KEYS.get(kind, [])
+            chunk = trips.groupby([trips[c] for c in cols] + [date]).size()
+            if counts is not None:
+                chunk = (pd.concat([counts, chunk])
+                         .groupby(level=list(range(len(cols) + 1))).sum())
+            self.counts[kind] = chunk
+
+
+def _top_k(values, labels, k):
+    """Positions of the k largest non-NaN values, ties broken by
+    label, found by partial selection instead of a full sort."""
+    if k == 0:
+        return []
+    valid = np.flatnonzero(~np.isnan(values))
+    if len(valid) > k:
+        kth = np.partition(values[valid], len(valid) - k)[len(valid) - k]
+        valid = valid[values[valid] >= kth]
+    return sorted(valid, key=lambda i: (-values[i], labels[i]))[:k]
+
+
+def _mean_estimates(daily, keys, totals, sampled, stratum=None):
+    """
+    Averages daily estimates over the days on which each group of
+    keys had trips and returns the means with their 95% error
+    bounds.
+
+    Active days are counted exactly on the days that were kept
+    whole. A subsampled day without sampled trips of a group may
+    still have had some, so the number of active subsampled days
+    is estimated from the group's share of all trips, assuming
+    trips are independent, and its variance is added to the
+    bounds.
+
+    Parameters
+    ----------
+    daily : data frame
+        Output of _DaySample.daily_estimates.
+    keys : list
+        Columns of daily to group by.
+    totals : dict
+        Number of trips on each day in scope, as an array per
+        stratum.
+    sampled : dict
+        Mask of the days in totals that were subsampled, as an
+        array per stratum.
+    stratum : str, optional
+        Key that gives the stratum of each group. Without it,
+        totals has a single stratum keyed 0.
+
+    Returns
+    -------
+    tuple of series
+    """
+    g = daily.groupby(keys, observed=True)
+    est = g['est'].sum()
+    var = g['var'].sum()
+    whole = g['whole'].sum().values.astype(float)
+    seen = g.size().values - whole
+    days = whole + seen
+    days_var = np.zeros(len(est))
+    if stratum is None:
+        strata = np.zeros(len(est))
+    else:
+        strata = est.index.get_level_values(stratum)
+    for s, n in totals.items():
+        at = np.flatnonzero(strata == s)
+        share = np.clip(est.values[at] / n.sum(), 0, 1)
+        # Chance that the group had trips on each subsampled day
+        active = 1 - (1 - share[:, None]) ** n[sampled[s]][None, :]
+        days[at] = whole[at] + np.maximum(seen[at], active.sum(axis=1))
+        days_var[at] = (active * (1 - active)).sum(axis=1)
+    mean = est / days
+    return mean, Z_95 * np.sqrt(var + mean ** 2 * days_var) / days
+
+
+class _Batch():
+    """
+    Tables of an open SakayDB.batch, each read from its csv once,
+    and the names of those written since, to be saved on exit.
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self.dirty = set()
+
+
+class _Snapshot():
+    """
+    Trips, drivers and locations as loaded from the csvs, with the
+    datetimes already parsed and a fingerprint of every trip, kept
+    in one binary file so that new processes can start without
+    parsing the csvs again.
+
+    The file holds a header with the format version, the
+    modification time and size of each csv the snapshot was taken
+    from and the layout of the arrays, followed by the raw arrays
+    aligned for memory mapping. Text columns are stored as fixed
+    width strings with a mask of the missing values. A snapshot is
+    only used while the csvs are unchanged.
+
+    Parameters
+    ----------
+    arrays : dict
+        Arrays keyed by table and column, e.g. 'trips.driver_id'.
+    sources
+        Modification times and sizes of the csvs.
+    """
+
+    VERSION = 2
+    MAGIC = b'SAKAYDB\x00'
+    ALIGN = 64
+    TRIPS = ['trip_id'] + TRIP_IDENTITY
+
+    def __init__(self, arrays, sources):
+        self.arrays = arrays
+        self.sources = sources
+
+    @classmethod
+    def build(cls, trips, drivers, locations, sources):
+        """Takes a snapshot of the tables as read with
+        compact=False."""
+        trips = _downcast(trips.infer_objects(), TRIPS_KEY_DTYPES)
+        drivers = _downcast(drivers, DRIVERS_DTYPES)
+        locations = _downcast(locations, LOCATIONS_DTYPES)
+        arrays = {}
+        for col in cls.TRIPS:
+            cls._store(arrays, 'trips.' + col, trips[col].values)
+        for col in ['pickup_datetime', 'dropoff_datetime']:
+            arrays['trips.' + col + '.parsed'] = (
+                _parse_datetimes(trips[col])[0])
+        arrays['trips.fingerprint'] = np.sort(_fingerprints(trips))
+        for table, df in [('drivers', drivers), ('locations', locations)]:
+            for col in df.columns:
+                cls._store(arrays, f'{table}.{col}', df[col].values)
+        return cls(arrays, sources)
+
+    @staticmethod
+    def _store(arrays, name, values):
+        """Adds values to arrays, with object values as strings and
+        the mask of the missing ones."""
+        if values.dtype == object:
+            arrays[name + '.missing'] = pd.isna(values)
+            values = np.where(arrays[name + '.missing'], '',
+                              values).astype(str)
+        arrays[name] = values
+
+    def _column(self, name):
+        """The values stored as name, with strings as objects and
+        the missing ones as NaN."""
+        values = self.arrays[name]
+        if values.dtype.kind != 'U':
+            return np.array(values)
+        values = values.astype(object)
+        values[self.arrays[name + '.missing']] = np.nan
+        return values
+
+    def contains(self, row):
+        """Whether a trip with the identity of row may exist. False
+        means it surely does not."""
+        try:
+            fingerprint = _fingerprints(
+                pd.DataFrame({col: [row[col]] for col in TRIP_IDENTITY}))
+        except (ValueError, TypeError):
+            return True
+        return _sorted_contains(self.arrays['trips.fingerprint'],
+                                fingerprint)[0]
+
+    def save(self, path):
+        """Writes the snapshot to path, replacing it atomically."""
+        layout = {}
+        offset = 0
+        for name, values in self.arrays.items():
+            layout[name] = [values.dtype.str, len(values), offset]
+            offset += -(-values.nbytes // self.ALIGN) * self.ALIGN
+        header = json.dumps({'version': self.VERSION,
+                             'sources': self.sources,
+                             'arrays': layout}).encode()
+        start = len(self.MAGIC) + 8 + len(header)
+        start = -(-start // self.ALIGN) * self.ALIGN
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.MAGIC + struct.pack('<Q', len(header)) + header)
+            for name, values in self.arrays.items():
+                f.seek(start + layout[name][2])
+                f.write(np.ascontiguousarray(values).tobytes())
+            f.truncate(start + offset)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, sources):
+        """Maps the snapshot at path into memory. Returns None if it
+        is missing, of another format version or was taken from
+        csvs other than those with the given sources."""
+        try:
+            data = np.memmap(path, dtype=np.uint8, mode='c')
+            if bytes(data[:len(cls.MAGIC)]) != cls.MAGIC:
+                return None
+            size = len(cls.MAGIC) + 8
+            length, = struct.unpack('<Q', bytes(data[len(cls.MAGIC):size]))
+            header = json.loads(bytes(data[size:size + length]))
+        except (OSError, ValueError):
+            return None
+        if (header['version'] != cls.VERSION
+                or header['sources'] != [list(s) if s else s
+                                         for s in sources]):
+            return None
+        start = -(-(size + length) // cls.ALIGN) * cls.ALIGN
+        arrays = {}
+        for name, (dtype, n, offset) in header['arrays'].items():
+            dtype = np.dtype(dtype)
+            begin = start + offset
+            arrays[name] = data[begin:begin + n * dtype.itemsize].view(dtype)
+        return cls(arrays, sources)
+
+    def trips(self, usecols=None, compact=True):
+        """The trips as _read_trips returns them."""
+        data = {}
+        for col in self.TRIPS:
+            if usecols is not None and col not in usecols:
+                continue
+            if (compact
+                    and col in ['pickup_datetime', 'dropoff_datetime']):
+                values = self.arrays['trips.' + col + '.parsed']
+            else:
+                values = self._column('trips.' + col)
+            if compact and col in TRIPS_METRIC_DTYPES:
+                values = values.astype(TRIPS_METRIC_DTYPES[col])
+            elif not compact and values.dtype.kind == 'i':
+                # Ids and counts as read from the csv
+                values = values.astype(np.int64)
+            data[col] = np.array(values)
+        return pd.DataFrame(data)
+
+    def table(self, table):
+        """The drivers or locations as read from their csv."""
+        prefix = table + '.'
+        return pd.DataFrame({
+            name[len(prefix):]: self._column(name)
+            for name in self.arrays
+            if name.startswith(prefix) and not name.endswith('.missing')})
+
+
+class _SQLiteStore():
+    """
+    Trips, drivers and locations kept in a local SQLite file, with
+    indexes for the lookups and range scans that SakayDB makes.
+    Datetimes are stored as ISO strings so that they sort and
+    compare chronologically.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite file, created if missing.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS drivers (
+            driver_id INTEGER PRIMARY KEY,
+            given_name TEXT NOT NULL,
+            last_name TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS drivers_name
+            ON drivers (lower(last_name), lower(given_name));
+        CREATE TABLE IF NOT EXISTS locations (
+            location_id INTEGER PRIMARY KEY,
+            loc_name TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS trips (
+            trip_id INTEGER PRIMARY KEY,
+            driver_id INTEGER NOT NULL REFERENCES drivers (driver_id),
+            pickup_datetime TEXT NOT NULL,
+            dropoff_datetime TEXT NOT NULL,
+            passenger_count INTEGER NOT NULL,
+            pickup_loc_id INTEGER NOT NULL
+                REFERENCES locations (location_id),
+            dropoff_loc_id INTEGER NOT NULL
+                REFERENCES locations (location_id),
+            trip_distance NUMERIC NOT NULL,
+            fare_amount NUMERIC NOT NULL,
+            UNIQUE (driver_id, pickup_datetime, dropoff_datetime,
+                    passenger_count, pickup_loc_id, dropoff_loc_id,
+                    trip_distance, fare_amount));
+        CREATE INDEX IF NOT EXISTS trips_driver ON trips (driver_id);
+        CREATE INDEX IF NOT EXISTS trips_pickup ON trips (pickup_datetime);
+        CREATE INDEX IF NOT EXISTS trips_dropoff
+            ON trips (dropoff_datetime);
+        CREATE INDEX IF NOT EXISTS trips_od
+            ON trips (pickup_loc_id, dropoff_loc_id);
+    """
+
+    COLUMNS = {'trips': ['trip_id', 'driver_id', 'pickup_datetime',
+                         'dropoff_datetime', 'passenger_count',
+                         'pickup_loc_id', 'dropoff_loc_id',
+                         'trip_distance', 'fare_amount'],
+               'drivers': ['driver_id', 'given_name', 'last_name'],
+               'locations': ['location_id', 'loc_name']}
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        with self.conn:
+            self.conn.executescript(self.SCHEMA)
+        self.batch = False
+
+    @contextmanager
+    def transaction(self):
+        """Runs the block as one transaction, committed on exit or
+        rolled back if the block raises."""
+        self.conn.execute('BEGIN')
+        self.batch = True
+        try:
+            yield
+        except BaseException:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+        finally:
+            self.batch = False
+
+    @contextmanager
+    def _atomic(self):
+        """Runs one write as its own transaction, or as a savepoint
+        inside an open one so that a failed write leaves the writes
+        before it in place."""
+        if not self.batch:
+            with self.conn:
+                yield
+            return
+        self.conn.execute('SAVEPOINT write')
+        try:
+            yield
+        except BaseException:
+            self.conn.execute('ROLLBACK TO write')
+            raise
+        finally:
+            self.conn.execute('RELEASE write')
+
+    def exists(self, table):
+        """Whether table has any rows."""
+        return self.conn.execute(
+            f'SELECT EXISTS (SELECT 1 FROM {table})').fetchone()[0] == 1
+
+    def read(self, table, columns=None):
+        """Reads columns of table in id order."""
+        columns = [c for c in self.COLUMNS[table]
+                   if columns is None or c in columns]
+        return pd.read_sql_query(
+            f'SELECT {", ".join(columns)} FROM {table} '
+            f'ORDER BY {self.COLUMNS[table][0]}', self.conn)
+
+    def load(self, drivers, locations, trips, ignore=False):
+        """Bulk inserts tables read from the csvs. With ignore,
+        trips that are already stored are skipped. Returns the
+        number of trips inserted."""
+        trips = trips.copy()
+        for col in ['pickup_datetime', 'dropoff_datetime']:
+            trips[col] = (pd.Series(_parse_datetimes(trips[col])[0])
+                          .dt.strftime(ISO_FORMAT).values)
+        with self._atomic():
+            for table, df in [('drivers', drivers),
+                              ('locations', locations),
+                              ('trips', trips)]:
+                columns = self.COLUMNS[table]
+                insert = ('INSERT OR IGNORE' if ignore and table == 'trips'
+                          else 'INSERT')
+                inserted = self.conn.executemany(
+                    f'{insert} INTO {table} ({", ".join(columns)}) '
+                    f'VALUES ({", ".join("?" * len(columns))})',
+                    df[columns].astype(object).itertuples(index=False)
+                ).rowcount
+        return inserted
+
+    def _location_id(self, loc_name):
+        row = self.conn.execute(
+            'SELECT location_id FROM locations WHERE loc_name = ?',
+            (loc_name,)).fetchone()
+        if row is not None:
+            return row[0]
+        return self.conn.execute(
+            'INSERT INTO locations (loc_name) VALUES (?)',
+            (loc_name,)).lastrowid
+
+    def add_trip(self, last_name, given_name, pickup_loc_name,
+                 dropoff_loc_name, trip):
+        """Adds a trip in one transaction, adding its driver and
+        locations if they are new. Returns the ids of the trip, the
+        driver and the pickup and dropoff locations."""
+        with self._atomic():
+            row = self.conn.execute(
+                'SELECT driver_id FROM drivers '
+                'WHERE lower(last_name) = lower(?) '
+                'AND lower(given_name) = lower(?)',
+                (last_name, given_name)).fetchone()
+            if row is not None:
+                driver_id = row[0]
+            else:
+                driver_id = self.conn.execute(
+                    'INSERT INTO drivers (given_name, last_name) '
+                    'VALUES (?, ?)', (given_name, last_name)).lastrowid
+            pickup_loc_id = self._location_id(pickup_loc_name)
+            dropoff_loc_id = self._location_id(dropoff_loc_name)
+            try:
+                trip_id = self.conn.execute(
+                    'INSERT INTO trips (driver_id, pickup_datetime, '
+                    'dropoff_datetime, passenger_count, pickup_loc_id, '
+                    'dropoff_loc_id, trip_distance, fare_amount) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (driver_id, trip['pickup_datetime'],
+                     trip['dropoff_datetime'], trip['passenger_count'],
+                     pickup_loc_id, dropoff_loc_id, trip['trip_distance'],
+                     trip['fare_amount'])).lastrowid
+            except sqlite3.IntegrityError:
+                raise SakayDBError
+        return trip_id, driver_id, pickup_loc_id, dropoff_loc_id
+
+    def delete_trip(self, trip_id):
+        """Deletes a trip and returns whether it existed."""
+        with self._atomic():
+            return self.conn.execute('DELETE FROM trips WHERE trip_id = ?',
+                                     (trip_id,)).rowcount > 0
+
+    @staticmethod
+    def _display(df):
+        """Converts the ISO datetimes of df back to DATETIME_FORMAT."""
+        for col in ['pickup_datetime', 'dropoff_datetime']:
+            if col not in df.columns:
+                continue
+            df[col] = (pd.Series(_parse_datetimes(df[col], ISO_FORMAT)[0])
+                       .dt.strftime(DATETIME_FORMAT).values)
+        return df
+
+    def search(self, where, params, order, columns=None, limit=None,
+               offset=0, after=None):
+        """Trips matching all the conditions in where, optionally
+        only the rows after trip after in order, and only a page of
+        limit rows from offset. sqlite stops once the page is full
+        when an index gives the order."""
+        where = list(where)
+        params = list(params)
+        if after is not None and self.conn.execute(
+                'SELECT 1 FROM trips WHERE trip_id = ?',
+                (after,)).fetchone() is None:
+            raise SakayDBError('Invalid cursor.')
+        if after is not None and order == ['trip_id']:
+            where.append('trip_id > ?')
+            params.append(after)
+        elif after is not None:
+            where.append(f'({", ".join(order)}) > '
+                         f'(SELECT {", ".join(order)} FROM trips '
+                         'WHERE trip_id = ?)')
+            params.append(after)
+        columns = [c for c in self.COLUMNS['trips']
+                   if columns is None or c in columns]
+        sql = f'SELECT {", ".join(columns)} FROM trips'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY ' + ', '.join(order)
+        if limit is not None or offset:
+            sql += ' LIMIT ? OFFSET ?'
+            params += [-1 if limit is None else limit, offset]
+        return self._display(pd.read_sql_query(sql, self.conn,
+                                               params=params))
+
+    def export(self):
+        """Trips joined with their driver and location names."""
+        return self._display(pd.read_sql_query("""
+            SELECT l2.loc_name AS dropoff_loc_name, t.passenger_count,
+                   t.trip_distance, t.dropoff_datetime, t.fare_amount,
+                   d.last_name AS driver_lastname,
+                   l1.loc_name AS pickup_loc_name,
+                   d.given_name AS driver_givenname, t.pickup_datetime
+            FROM trips t
+            JOIN drivers d ON d.driver_id = t.driver_id
+            JOIN locations l1 ON l1.location_id = t.pickup_loc_id
+            JOIN locations l2 ON l2.location_id = t.dropoff_loc_id
+            ORDER BY t.trip_id""", self.conn))
+
+    def weekday_means(self, key=None):
+        """Average number of trips per day of week over the days with
+        trips, optionally per value of key, grouped in SQL."""
+        keys = '' if key is None else key + ', '
+        means = pd.read_sql_query(f"""
+            SELECT {keys}(CAST(strftime('%w', d) AS INTEGER) + 6) % 7
+                   AS day, AVG(n) AS mean
+            FROM (SELECT {keys}date(pickup_datetime) AS d, COUNT(*) AS n
+                  FROM trips GROUP BY {keys}d)
+            GROUP BY {keys}day""", self.conn)
+        means['day'] = np.array(WEEK)[means['day'].values]
+        return means.set_index(([] if key is None else [key]) +
+                               ['day'])['mean']
+
+    def daily_counts(self, key):
+        """Number of trips per value of key and day, grouped in
+        SQL."""
+        counts = pd.read_sql_query(f"""
+            SELECT {key}, date(pickup_datetime) AS date, COUNT(*) AS n
+            FROM trips GROUP BY {key}, date""", self.conn)
+        counts['date'] = pd.to_datetime(counts['date'])
+        return counts.set_index([key, 'date'])['n']
+
+    def od_means(self, where, params):
+        """Average number of trips per day with trips of each pickup
+        and dropoff pair, grouped in SQL."""
+        where = ' WHERE ' + ' AND '.join(where) if where else ''
+        return pd.read_sql_query(f"""
+            SELECT pickup_loc_id, dropoff_loc_id, AVG(n) AS mean
+            FROM (SELECT pickup_loc_id, dropoff_loc_id,
+                         date(pickup_datetime) AS d, COUNT(*) AS n
+                  FROM trips{where}
+                  GROUP BY pickup_loc_id, dropoff_loc_id, d)
+            GROUP BY pickup_loc_id, dropoff_loc_id""", self.conn,
+                                 params=params)
+
+
 class SakayDB():
 
-    def __init__(self, data_dir):
+    def __init__(self, data_dir, cache_size=128, cache_bytes=None,
+                 backend='csv', snapshot=None):
         """Initializes by taking path to the data
-        and reading the necessary csvs for SakayDB."""
+        and reading the necessary csvs for SakayDB.
+
+        Results of search_trips and generate_odmatrix are cached
+        until the next write; cache_size bounds the number of
+        cached results and cache_bytes their total memory.
+
+        With backend='sqlite', the tables are kept in sakaydb.db in
+        data_dir instead of the csvs, which are imported when the
+        file is first created.
+
+        With snapshot, the csvs are loaded from a snapshot file, the
+        given path or sakaydb.snapshot in data_dir if snapshot is
+        True, for as long as they are unchanged since it was saved.
+        A missing or outdated snapshot is saved again, so only the
+        first process after a change parses the csvs."""
+        if backend not in ['csv', 'sqlite']:
+            raise SakayDBError('Invalid backend.')
+        if snapshot is not None and backend != 'csv':
+            raise SakayDBError('Snapshots are only for the csv backend.')
         self.data_dir = data_dir
+        self._store = None
+        self._batch = None
+        self._snapshot = None
+        self._snapshot_path = (os.path.join(data_dir, 'sakaydb.snapshot')
+                               if snapshot is True else snapshot)
+        if backend == 'sqlite':
+            path = os.path.join(data_dir, 'sakaydb.db')
+            if not os.path.isfile(path):
+                self._create_sqlite(path)
+            self._store = _SQLiteStore(path)
+        self._version = 0
+        self._cache = _ResultCache(cache_size, cache_bytes)
+        self._sample = None
+        self._counts = None
+        self._day_counts = None
+        self._names = None
+        if self._snapshot_path is not None:
+            self._snapshot = _Snapshot.load(self._snapshot_path,
+                                            self._file_stats(CSV_NAMES))
+            if self._snapshot is None and self._exists(*CSV_NAMES):
+                self.save_snapshot()
+
+    def _create_sqlite(self, path):
+        """Creates the sqlite database at path from the csvs. It is
+        built in a temporary file that only replaces path once the
+        load succeeds, so a failed load is tried again on the next
+        open instead of leaving an empty database behind."""
+        tmp = path + '.tmp'
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        store = _SQLiteStore(tmp)
+        try:
+            if self._exists('trips.csv', 'drivers.csv', 'locations.csv'):
+                drivers = self._read_drivers()
+                locations = self._read_locations()
+                # Trips of unknown drivers or locations are left out,
+                # as the csv backend leaves them out of its statistics
+                # and exports, and would fail the foreign keys
+                trips = self._known(self._read_trips(compact=False),
+                                    drivers, locations)
+                store.load(drivers, locations, trips)
+        except BaseException:
+            store.conn.close()
+            os.remove(tmp)
+            raise
+        store.conn.close()
+        os.replace(tmp, path)
+
+    def _file_stats(self, names):
+        """Modification time and size of each named file in
+        data_dir, None for missing files."""
+        stats = []
+        for name in names:
+            try:
+                st = os.stat(os.path.join(self.data_dir, name))
+                stats.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stats.append(None)
+        return tuple(stats)
+
+    def _data_version(self):
+        """Write counter of this instance together with the
+        modification time and size of each data file, so writes
+        made through other instances also invalidate the cache."""
+        if self._store is not None:
+            names = ['sakaydb.db']
+        else:
+            names = CSV_NAMES
+        return (self._version,) + self._file_stats(names)
+
+    def _cached(self, key, compute):
+        """Returns the cached result for key or computes it."""
+        return self._cache.get(key, self._data_version(), compute)
+
+    def cache_info(self):
+        """
+        Returns the hit and miss counts, hit rate and current size
+        of the query result cache.
+
+        Returns
+        -------
+        dict
+        """
+        return self._cache.info()
+
+    def cache_clear(self):
+        """Empties the query result cache."""
+        self._cache.clear()
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager that groups writes. Inside the block,
+        add_trip, add_trips and delete_trip change in-memory copies
+        of the tables, which reads also see, and the tables are
+        saved once on exit instead of on every write. If the block
+        raises, its writes are discarded. With the sqlite backend,
+        the block runs as one transaction.
+
+        Batches do not nest; a batch opened inside another joins it.
+
+        Examples
+        --------
+        >>> with db.batch():
+        ...     trip_id = db.add_trip(**trip)
+        ...     db.delete_trip(trip_id)
+        """
+        if self._batch is not None:
+            yield self
+            return
+        self._batch = _Batch()
+        try:
+            if self._store is not None:
+                with self._store.transaction():
+                    yield self
+            else:
+                yield self
+        except BaseException:
+            self._batch = None
+            self._version += 1
+            self._sample = None
+            self._counts = None
+            self._day_counts = None
+            self._names = None
+            raise
+        batch, self._batch = self._batch, None
+        version = self._data_version()
+        for name in batch.dirty:
+            batch.tables[name].to_csv(os.path.join(self.data_dir, name),
+                                      index=False)
+        # The synopses already hold the batch's trips and drivers
+        synopses = [self._sample, self._counts, self._day_counts,
+                    self._names]
+        new_version = self._data_version()
+        for synopsis in synopses:
+            if synopsis is not None and synopsis.version == version:
+                synopsis.version = new_version
+
+    transaction = batch
+
+    def save_snapshot(self, path=None):
+        """
+        Saves the tables, with the datetimes parsed and a fingerprint
+        of every trip, to a snapshot file that
+        SakayDB(data_dir, snapshot=path) starts from.
+
+        Parameters
+        ----------
+        path : str, optional
+            Defaults to the snapshot the instance was created with,
+            or sakaydb.snapshot in data_dir.
+
+        Returns
+        -------
+        str
+            Path of the snapshot.
+        """
+        if self._store is not None:
+            raise SakayDBError('Snapshots are only for the csv backend.')
+        if self._batch is not None:
+            raise SakayDBError('Cannot save a snapshot inside a batch.')
+        if path is None:
+            path = self._snapshot_path
+        if path is None:
+            path = os.path.join(self.data_dir, 'sakaydb.snapshot')
+        snapshot = self._fresh_snapshot()
+        if snapshot is None:
+            if not self._exists(*CSV_NAMES):
+                raise SakayDBError
+            sources = self._file_stats(CSV_NAMES)
+            snapshot = _Snapshot.build(self._read_trips(compact=False),
+                                       self._read_drivers(),
+                                       self._read_locations(), sources)
+            self._snapshot = snapshot
+        snapshot.save(path)
+        return path
+
+    def _fresh_snapshot(self):
+        """The snapshot, if the csvs are unchanged since it was
+        taken. Batches read and write their own tables."""
+        if (self._snapshot is None or self._batch is not None
+                or self._snapshot.sources != self._file_stats(CSV_NAMES)):
+            return None
+        return self._snapshot
+
+    def _write_csv(self, df, name):
+        """Writes df to name in data_dir and bumps the data
+        version so that cached query results are invalidated.
+        Inside a batch, df only replaces the in-memory table."""
+        if self._batch is not None:
+            self._batch.tables[name] = df.infer_objects()
+            self._batch.dirty.add(name)
+        else:
+            df.to_csv(os.path.join(self.data_dir, name), index=False)
+        self._version += 1
+
+    def _append_csv(self, df, name):
+        """Appends the rows of df to name in data_dir, or to the
+        in-memory table inside a batch."""
+        if len(df) == 0:
+            return
+        if self._batch is not None:
+            if self._exists(name):
+                df = pd.concat([self._read_csv(name), df],
+                               ignore_index=True)
+            self._write_csv(df, name)
+            return
+        path = os.path.join(self.data_dir, name)
+        exists = os.path.isfile(path)
+        if exists:
+            # Rows are appended by position, so follow the file's header
+            columns = pd.read_csv(path, nrows=0).columns
+            if set(columns) != set(df.columns):
+                raise SakayDBError(f'Columns of {name} do not match.')
+            df = df[columns]
+        df.to_csv(path, mode='a', header=not exists, index=False)
+        self._version += 1
+
+    def _read_csv(self, name, usecols=None, dtype=None):
+        """Reads name from data_dir, narrowed to dtype by _downcast.
+        Inside a batch, the table is read once and later reads are
+        served from memory."""
+        path = os.path.join(self.data_dir, name)
+        if self._batch is None:
+            df = pd.read_csv(path, usecols=usecols)
+        else:
+            if name not in self._batch.tables:
+                self._batch.tables[name] = pd.read_csv(path)
+            df = self._batch.tables[name]
+            if usecols is not None:
+                df = df[[col for col in df.columns if col in usecols]]
+        return _downcast(df, dtype or {})
+
+    def _exists(self, *names):
+        """Whether the named csvs exist. With the sqlite backend,
+        a table counts as existing once it has rows."""
+        if self._store is not None:
+            return all(self._store.exists(name.split('.')[0])
+                       for name in names)
+        return all((self._batch is not None
+                    and name in self._batch.tables)
+                   or os.path.isfile(os.path.join(self.data_dir, name))
+                   for name in names)
+
+    def _read_trips(self, usecols=None, compact=True):
+        """Reads trips.csv. With compact, ids, counts and metrics
+        are narrowed to the compact schema and datetimes are parsed;
+        otherwise the trips are kept as written so they round-trip
+        to csv unchanged."""
+        snapshot = self._fresh_snapshot()
+        if snapshot is not None:
+            return snapshot.trips(usecols, compact)
+        dtype = {}
+        if compact:
+            dtype = dict(TRIPS_KEY_DTYPES, **TRIPS_METRIC_DTYPES)
+        if self._store is not None:
+            trips = _downcast(self._store.read('trips', usecols), dtype)
+            datetime_format = ISO_FORMAT
+        else:
+            trips = self._read_csv('trips.csv', usecols=usecols,
+                                   dtype=dtype)
+            datetime_format = DATETIME_FORMAT
+        for col in ['pickup_datetime', 'dropoff_datetime']:
+            if col not in trips.columns:
+                continue
+            if compact:
+                trips[col] = _parse_datetimes(trips[col],
+                                              datetime_format)[0]
+            elif self._store is not None:
+                trips[col] = (pd.Series(_parse_datetimes(
+                    trips[col], datetime_format)[0])
+                    .dt.strftime(DATETIME_FORMAT).values)
+        return trips
+
+    def _read_drivers(self):
+        """Reads drivers.csv using the compact schema."""
+        snapshot = self._fresh_snapshot()
+        if snapshot is not None:
+            return snapshot.table('drivers')
+        if self._store is not None:
+            return _downcast(self._store.read('drivers'), DRIVERS_DTYPES)
+        return self._read_csv('drivers.csv', dtype=DRIVERS_DTYPES)
+
+    def _read_locations(self):
+        """Reads locations.csv using the compact schema."""
+        snapshot = self._fresh_snapshot()
+        if snapshot is not None:
+            return snapshot.table('locations')
+        if self._store is not None:
+            return _downcast(self._store.read('locations'),
+                             LOCATIONS_DTYPES)
+        return self._read_csv('locations.csv', dtype=LOCATIONS_DTYPES)
 
     def add_trip(self, driver, pickup_datetime, dropoff_datetime,
                  passenger_count, pickup_loc_name, dropoff_loc_name,
@@ -52,8 +1600,15 @@ class SakayDB():
         int
             The ID number of the added trip in trips.csv.
         """
+        if self._store is not None:
+            return self._sqlite_add_trip(driver, pickup_datetime,
+                                         dropoff_datetime, passenger_count,
+                                         pickup_loc_name, dropoff_loc_name,
+                                         trip_distance, fare_amount)
+
+        snapshot = self._fresh_snapshot()
         try:
-            trips = pd.read_csv(os.path.join(self.data_dir, 'trips.csv'))
+            trips = self._read_trips(compact=False)
         except FileNotFoundError:
             trips = pd.DataFrame(columns=['trip_id',
                                           'driver_id',
@@ -65,15 +1620,14 @@ class SakayDB():
                                           'trip_distance',
                                           'fare_amount'])
         try:
-            drivers = pd.read_csv(os.path.join(self.data_dir, 'drivers.csv'))
+            drivers = self._read_drivers()
         except FileNotFoundError:
             drivers = pd.DataFrame(columns=['driver_id',
                                             'given_name',
                                             'last_name'])
 
         try:
-            locations = pd.read_csv(os.path.join(self.data_dir,
-                                                 'locations.csv'))
+            locations = self._read_locations()
         except FileNotFoundError:
             locations = pd.DataFrame(columns=['location_id',
                                               'loc_name'])
@@ -83,6 +1637,8 @@ class SakayDB():
         given_name = names[1]
         pickup_loc_name = pickup_loc_name.strip()
         dropoff_loc_name = dropoff_loc_name.strip()
+        driver_key = _DriverNames.key(last_name, given_name)
+        known_drivers = self._driver_names(drivers).lookup
 
         if drivers.shape[0] == 0:
             driver_id = 1
@@ -92,14 +1648,8 @@ class SakayDB():
                 'last_name': [last_name]
             })
             drivers = pd.concat([drivers, new_row], ignore_index=True)
-        elif drivers[(drivers.given_name.str.lower() == given_name.lower())
-                     & (drivers.last_name.str.lower() == last_name.lower())
-                     ].shape[0] > 0:
-            driver_id = (drivers[(drivers.given_name.str.lower()
-                                  == given_name.lower()) &
-                                 (drivers.last_name.str.lower()
-                                  == last_name.lower())]
-                         ['driver_id'].values[0])
+        elif driver_key in known_drivers:
+            driver_id = known_drivers[driver_key]
         else:
             driver_id = drivers['driver_id'].iloc[-1] + 1
             new_row = pd.DataFrame({
@@ -152,8 +1702,10 @@ class SakayDB():
         try:
             if trips.shape[0] == 0:
                 row['trip_id'] = 1
-            elif row in (trips.loc[:, trips.columns != 'trip_id']
-                              .to_dict(orient='records')):
+            # Only trips with the same fingerprint can be duplicates
+            elif ((snapshot is None or snapshot.contains(row))
+                  and row in (trips.loc[:, trips.columns != 'trip_id']
+                              .to_dict(orient='records'))):
                 raise SakayDBError
             else:
                 row['trip_id'] = trips['trip_id'].iloc[-1] + 1
@@ -162,45 +1714,324 @@ class SakayDB():
         except SakayDBError:
             raise SakayDBError
 
-        trips.to_csv(os.path.join(self.data_dir, 'trips.csv'),
-                     index=False)
-        drivers.to_csv(os.path.join(self.data_dir, 'drivers.csv'),
-                       index=False)
-        locations.to_csv(os.path.join(self.data_dir, 'locations.csv'),
-                         index=False)
+        version = self._data_version()
+        self._write_csv(trips, 'trips.csv')
+        self._write_csv(drivers, 'drivers.csv')
+        self._write_csv(locations, 'locations.csv')
+        self._synopses_add(row, version)
+        self._names_add(version, driver_id, given_name, last_name)
+        if snapshot is not None:
+            self._snapshot = _Snapshot.build(trips, drivers, locations,
+                                             self._file_stats(CSV_NAMES))
 
         return trips['trip_id'].iloc[-1]
 
-    def add_trips(self, trips):
+    def _sqlite_add_trip(self, driver, pickup_datetime, dropoff_datetime,
+                         passenger_count, pickup_loc_name, dropoff_loc_name,
+                         trip_distance, fare_amount):
+        """add_trip for the sqlite backend, as one transaction."""
+        names = driver.strip().split(', ')
+        last_name = names[0]
+        given_name = names[1]
+        pickup = _parse_datetime(pickup_datetime)
+        dropoff = _parse_datetime(dropoff_datetime)
+        if pickup is pd.NaT or dropoff is pd.NaT:
+            raise ValueError('Invalid datetime.')
+        trip = {
+            'pickup_datetime': pickup.strftime(ISO_FORMAT),
+            'dropoff_datetime': dropoff.strftime(ISO_FORMAT),
+            'passenger_count': passenger_count,
+            'trip_distance': trip_distance,
+            'fare_amount': fare_amount
+        }
+        version = self._data_version()
+        trip_id, driver_id, pickup_loc_id, dropoff_loc_id = (
+            self._store.add_trip(last_name, given_name,
+                                 pickup_loc_name.strip(),
+                                 dropoff_loc_name.strip(), trip))
+        self._version += 1
+        self._synopses_add({
+            'driver_id': driver_id,
+            'pickup_datetime': pickup_datetime,
+            'dropoff_datetime': dropoff_datetime,
+            'passenger_count': passenger_count,
+            'pickup_loc_id': pickup_loc_id,
+            'dropoff_loc_id': dropoff_loc_id
+        }, version)
+        self._names_add(version, driver_id, given_name, last_name)
+        return trip_id
+
+    def add_trips(self, trips, return_codes=False):
         """
         Function will add multiple trips to to trips.csv. This is
-        an extension to add_trip for multiple trips. Errors will
-        be raised if the trip is either invalid or already exists.
+        an extension to add_trip for multiple trips. The trips are
+        checked together by validate_trips first, and the invalid
+        ones and those that already exist are skipped.
 
         Parameters
         ----------
         trips : list
             List of dictionaries containing inputs for the add_trip
-            function. The contents of each dictionary should be
-            valid or errors will be raised.
+            function.
+        return_codes : bool
+            Whether to also return the code of each trip, with
+            TRIP_DUPLICATE for those already in the database.
 
         Returns
         -------
         list
             List of trip_ids that were successfully addd to the
             trips.csv file.
+        numpy.ndarray
+            Code of each trip, indexing TRIP_ERRORS, if
+            return_codes is True.
         """
+        codes = self.validate_trips(trips)
         out = []
-        for i, trip in enumerate(trips):
-            try:
-                out.append(self.add_trip(**trip))
-            except SakayDBError:
-                print(f"Warning: trip index {i} is already in the "
-                      "database. Skipping...")
-            except Exception as e:
-                print(f"Warning: trip index {i} has invalid or "
-                      "incomplete information. Skipping...")
-        return out
+        with self.batch():
+            for i in np.flatnonzero(codes == TRIP_OK):
+                try:
+                    out.append(self.add_trip(**trips[i]))
+                except SakayDBError:
+                    codes[i] = TRIP_DUPLICATE
+        return (out, codes) if return_codes else out
+
+    def validate_trips(self, trips):
+        """
+        Checks trips for add_trips as columns rather than one at a
+        time: the fields present, the form of the driver names,
+        location names and datetimes, dropoff not before pickup,
+        non-negative distances and fares, and non-negative integer
+        passenger counts. Whether a trip already exists is left to
+        add_trip.
+
+        Parameters
+        ----------
+        trips : list
+            List of dictionaries containing inputs for the add_trip
+            function.
+
+        Returns
+        -------
+        numpy.ndarray
+            int8 code of each trip: TRIP_OK, or the code of its
+            first error, which indexes TRIP_ERRORS.
+        """
+        codes = np.zeros(len(trips), dtype=np.int8)
+
+        def flag(bad, code):
+            codes[(codes == TRIP_OK) & bad] = code
+
+        # Anything but a dictionary has no known fields
+        trips = [trip if isinstance(trip, dict) else {None: trip}
+                 for trip in trips]
+        columns = {col: pd.Series([trip.get(col) for trip in trips],
+                                  dtype=object)
+                   for col in TRIP_FIELDS}
+        fields = set(TRIP_FIELDS)
+        known = np.fromiter((set(trip) <= fields for trip in trips),
+                            dtype=bool, count=len(trips))
+        flag(~known | pd.DataFrame(columns).isna().any(axis=1).values,
+             TRIP_MISSING)
+
+        strings = {col: _instances(values, str)
+                   for col, values in columns.items()}
+        names = (columns['driver'].where(strings['driver'], '')
+                 .str.strip().str.split(', '))
+        checked = {col: columns[col].where(strings[col])
+                   for col in ['pickup_loc_name', 'dropoff_loc_name',
+                               'pickup_datetime', 'dropoff_datetime']}
+        for col in ['passenger_count', 'trip_distance', 'fare_amount']:
+            checked[col] = pd.to_numeric(
+                columns[col].mask(_instances(columns[col], (bool, np.bool_))),
+                errors='coerce')
+        found = _trip_codes(names, checked)
+        codes[codes == TRIP_OK] = found[codes == TRIP_OK]
+        # A float is not a passenger count even if it is whole
+        flag(_instances(columns['passenger_count'], (float, np.floating)),
+             TRIP_BAD_PASSENGERS)
+        return codes
+
+    def import_file(self, path, chunksize=CHUNK_SIZE):
+        """
+        Imports the trips in a csv with the columns of export_data,
+        or with a driver column of names in the form
+        Last name, Given name in place of driver_lastname and
+        driver_givenname.
+
+        The file is read chunksize rows at a time. Names are matched
+        to drivers and locations as add_trip matches them, and the
+        new ones get ids in bulk. Trips already in the database or
+        earlier in the file are skipped by their fingerprint, as are
+        rows with missing values and rows that validate_trips would
+        reject. New rows are appended to the csvs instead of
+        rewriting them.
+
+        Parameters
+        ----------
+        path : str
+            Path to the csv to import.
+        chunksize : int
+            Number of rows read at a time.
+
+        Returns
+        -------
+        int
+            Number of trips imported.
+        """
+        if type(chunksize) != int or chunksize <= 0:
+            raise SakayDBError('Invalid chunksize.')
+        chunks = pd.read_csv(path, chunksize=chunksize, dtype={
+            col: str for col in ['driver', 'driver_lastname',
+                                 'driver_givenname', 'pickup_loc_name',
+                                 'dropoff_loc_name', 'pickup_datetime',
+                                 'dropoff_datetime']})
+
+        if self._exists('drivers.csv'):
+            drivers = self._read_drivers()
+        else:
+            drivers = pd.DataFrame(columns=['driver_id', 'given_name',
+                                            'last_name'])
+        if self._exists('locations.csv'):
+            locations = self._read_locations()
+        else:
+            locations = pd.DataFrame(columns=['location_id', 'loc_name'])
+        known, last_trip_id = self._known_trips()
+        imported = 0
+
+        for chunk in chunks:
+            rows = self._import_rows(chunk)
+
+            driver_ids, new_drivers = self._assign_ids(
+                _DriverNames.keys(rows['last_name'],
+                                  rows['given_name']).values,
+                _DriverNames.keys(drivers['last_name'],
+                                  drivers['given_name']).values,
+                drivers['driver_id'].values)
+            new_drivers = pd.DataFrame({
+                'driver_id': driver_ids[new_drivers],
+                'given_name': rows['given_name'].values[new_drivers],
+                'last_name': rows['last_name'].values[new_drivers]})
+
+            # Pickup then dropoff of each row, in the order add_trip
+            # would number them
+            loc_names = rows[['pickup_loc_name',
+                              'dropoff_loc_name']].values.ravel()
+            loc_ids, new_locations = self._assign_ids(
+                loc_names, locations['loc_name'].values,
+                locations['location_id'].values)
+            new_locations = pd.DataFrame({
+                'location_id': loc_ids[new_locations],
+                'loc_name': loc_names[new_locations]})
+
+            trips = pd.DataFrame({
+                'driver_id': driver_ids,
+                'pickup_datetime': rows['pickup_datetime'].values,
+                'dropoff_datetime': rows['dropoff_datetime'].values,
+                'passenger_count': rows['passenger_count'].values,
+                'pickup_loc_id': loc_ids[0::2],
+                'dropoff_loc_id': loc_ids[1::2],
+                'trip_distance': rows['trip_distance'].values,
+                'fare_amount': rows['fare_amount'].values})
+            fingerprints = _fingerprints(trips)
+            keep = (~_sorted_contains(known, fingerprints)
+                    & ~pd.Series(fingerprints).duplicated().values)
+            trips = trips.loc[keep]
+            added = np.sort(fingerprints[keep])
+            known = np.insert(known, np.searchsorted(known, added), added)
+            trips.insert(0, 'trip_id', np.arange(
+                last_trip_id + 1, last_trip_id + 1 + len(trips)))
+            last_trip_id += len(trips)
+
+            if self._store is not None:
+                imported += self._store.load(new_drivers, new_locations,
+                                             trips, ignore=True)
+                self._version += 1
+            else:
+                self._append_csv(new_drivers, 'drivers.csv')
+                self._append_csv(new_locations, 'locations.csv')
+                self._append_csv(trips, 'trips.csv')
+                imported += len(trips)
+            drivers = pd.concat([drivers, new_drivers], ignore_index=True)
+            locations = pd.concat([locations, new_locations],
+                                  ignore_index=True)
+        return imported
+
+    @staticmethod
+    def _import_rows(chunk):
+        """Rows of a chunk of an import_file csv with the driver
+        names split and the location names stripped as add_trip
+        does, without the rows missing a value or failing the checks
+        of validate_trips."""
+        columns = ['pickup_loc_name', 'dropoff_loc_name', 'pickup_datetime',
+                   'dropoff_datetime', 'passenger_count', 'trip_distance',
+                   'fare_amount']
+        if 'driver' in chunk.columns:
+            names = chunk['driver'].str.strip().str.split(', ')
+        elif {'driver_lastname', 'driver_givenname'} <= set(chunk.columns):
+            names = pd.Series(
+                [[last, given] for last, given in zip(
+                    chunk['driver_lastname'].fillna(''),
+                    chunk['driver_givenname'].fillna(''))],
+                index=chunk.index, dtype=object)
+        else:
+            raise SakayDBError('Invalid file.')
+        if not set(columns) <= set(chunk.columns):
+            raise SakayDBError('Invalid file.')
+
+        rows = pd.DataFrame({
+            'last_name': names.str[0],
+            'given_name': names.str[1],
+            'pickup_loc_name': chunk['pickup_loc_name'].str.strip(),
+            'dropoff_loc_name': chunk['dropoff_loc_name'].str.strip(),
+            'pickup_datetime': chunk['pickup_datetime'],
+            'dropoff_datetime': chunk['dropoff_datetime']})
+        for col in ['passenger_count', 'trip_distance', 'fare_amount']:
+            rows[col] = pd.to_numeric(chunk[col], errors='coerce')
+        ok = (rows.notna().all(axis=1).values
+              & (_trip_codes(names, rows) == TRIP_OK))
+        rows = rows.loc[ok]
+        return rows.astype({'passenger_count': 'int64'})
+
+    @staticmethod
+    def _assign_ids(keys, known_keys, known_ids):
+        """Ids of keys among known_keys, as the first match add_trip
+        takes, numbering new keys after the last known id in order
+        of first appearance. Returns the ids and the mask of the
+        first appearance of each new key."""
+        first_known = ~pd.Series(known_keys, dtype=object).duplicated()
+        pos = pd.Index(known_keys[first_known.values]).get_indexer(keys)
+        new = pos < 0
+        first = new & ~pd.Series(keys, dtype=object).duplicated().values
+        start = int(known_ids[-1]) + 1 if len(known_ids) else 1
+        new_ids = np.arange(start, start + first.sum())
+        ids = np.empty(len(keys), dtype=np.int64)
+        ids[~new] = known_ids[first_known.values][pos[~new]]
+        ids[new] = new_ids[pd.Index(keys[first]).get_indexer(keys[new])]
+        return ids, first
+
+    def _known_trips(self):
+        """Sorted fingerprints of the stored trips and the last
+        trip_id, reading trips.csv in chunks."""
+        if not self._exists('trips.csv'):
+            return np.array([], dtype=np.uint64), 0
+        snapshot = self._fresh_snapshot()
+        if snapshot is not None:
+            ids = snapshot.arrays['trips.trip_id']
+            return (np.array(snapshot.arrays['trips.fingerprint']),
+                    int(ids[-1]) if len(ids) else 0)
+        if self._store is not None or self._batch is not None:
+            chunks = [self._read_trips(compact=False)]
+        else:
+            chunks = pd.read_csv(os.path.join(self.data_dir, 'trips.csv'),
+                                 chunksize=CHUNK_SIZE)
+        found = [np.array([], dtype=np.uint64)]
+        last_trip_id = 0
+        for chunk in chunks:
+            found.append(_fingerprints(chunk))
+            if len(chunk):
+                last_trip_id = int(chunk['trip_id'].iloc[-1])
+        return np.sort(np.concatenate(found)), last_trip_id
 
     def delete_trip(self, trip_id):
         """
@@ -212,10 +2043,17 @@ class SakayDB():
         trip_id
             The id of the trip to delete.
         """
-        if not os.path.isfile(os.path.join(self.data_dir, 'trips.csv')):
+        if self._store is not None:
+            if not self._store.delete_trip(trip_id):
+                raise SakayDBError
+            self._version += 1
+            return
+
+        snapshot = self._fresh_snapshot()
+        if not self._exists('trips.csv'):
             raise SakayDBError
         else:
-            df = pd.read_csv(os.path.join(self.data_dir, 'trips.csv'))
+            df = self._read_trips(compact=False)
 
         cond = trip_id in df['trip_id'].values
         if not cond:
@@ -223,15 +2061,30 @@ class SakayDB():
         else:
             df.drop(df.index[df['trip_id'] == trip_id], inplace=True)
 
-        df.to_csv(os.path.join(self.data_dir, 'trips.csv'), index=False)
+        self._write_csv(df, 'trips.csv')
+        if snapshot is not None:
+            self._snapshot = _Snapshot.build(
+                df, snapshot.table('drivers'), snapshot.table('locations'),
+                self._file_stats(CSV_NAMES))
 
-    def search_trips(self, **kwargs):
+    def search_trips(self, limit=None, offset=0, after=None, columns=None,
+                     **kwargs):
         """
         This function will search through trips.csv and return trips
         based on the filter parameters.
 
         Parameters
         ----------
+        limit : int, optional
+            Return at most this many trips.
+        offset : int
+            Number of trips to skip before the first returned.
+        after : int, optional
+            Cursor: the trip_id of the last trip of the previous
+            page. Only the trips after it in the result order are
+            returned. Raises SakayDBError if no trip has that id.
+        columns : list, optional
+            Columns of trips.csv to return. Defaults to all.
         kwargs : dict
             Parameters follow the same type and format as add_trip
             functions.
@@ -239,14 +2092,130 @@ class SakayDB():
         Returns
         -------
         data frame
+            Trips in trip_id order, or in the order of the last range
+            filter given. Pages are ordered by that column and then
+            by trip_id.
         """
-        if not os.path.isfile(os.path.join(self.data_dir, 'trips.csv')):
+        key = ('search_trips', tuple(kwargs.items()), limit,
+               offset, after, None if columns is None else tuple(columns))
+        return self._cached(key, lambda: self._search_page(
+            kwargs, limit, offset, after, columns))
+
+    def _search_page(self, kwargs, limit, offset, after, columns):
+        """Uncached search_trips. Pages in trip_id order with only
+        equality filters on numeric columns are scanned from the
+        csv chunk by chunk; other pages are sliced from the full
+        result."""
+        if limit is None and offset == 0 and after is None and (
+                columns is None):
+            return self._search_trips(**kwargs)
+
+        trip_columns = _SQLiteStore.COLUMNS['trips']
+        if limit is not None and (type(limit) != int or limit < 0):
+            raise SakayDBError('Invalid limit.')
+        if type(offset) != int or offset < 0:
+            raise SakayDBError('Invalid offset.')
+        if after is not None and type(after) != int:
+            raise SakayDBError('Invalid cursor.')
+        if columns is not None and (
+                isinstance(columns, str)
+                or not all(col in trip_columns for col in columns)):
+            raise SakayDBError('Invalid columns.')
+        columns = [col for col in trip_columns
+                   if columns is None or col in columns]
+
+        if self._store is not None:
+            return self._sqlite_search(kwargs, limit, offset, after, columns)
+        # Ordered by the last range filter
+        order = 'trip_id'
+        for key, val in kwargs.items():
+            if type(val) == tuple:
+                order = key
+
+        if (self._batch is None and self._exists('trips.csv') and kwargs
+                and all(key in ['driver_id', 'passenger_count',
+                                'trip_distance', 'fare_amount']
+                        and type(val) in [int, float]
+                        for key, val in kwargs.items())):
+            return self._scan_trips(kwargs, limit, offset, after, columns)
+
+        trips = self.search_trips(**kwargs)
+        if isinstance(trips, list):
+            return trips
+        if after is not None:
+            table = self._read_trips(usecols=list({'trip_id', order}),
+                                     compact=False)
+            cursor = table.loc[table['trip_id'] == after, order].values
+            if len(cursor) == 0:
+                raise SakayDBError('Invalid cursor.')
+        if order == 'trip_id':
+            if after is not None:
+                trips = trips[trips['trip_id'].values > after]
+        else:
+            keys = trips[order].values
+            if keys.dtype == object:
+                keys = _parse_datetimes(keys)[0]
+            ids = trips['trip_id'].values
+            if after is not None:
+                if cursor.dtype == object:
+                    cursor = _parse_datetimes(cursor)[0]
+                mask = (keys > cursor[0]) | ((keys == cursor[0])
+                                             & (ids > after))
+                trips, keys, ids = trips[mask], keys[mask], ids[mask]
+            trips = trips.iloc[np.lexsort((ids, keys))]
+        stop = None if limit is None else offset + limit
+        return trips.iloc[offset:stop][columns].reset_index(drop=True)
+
+    def _scan_trips(self, filters, limit, offset, after, columns):
+        """Reads trips.csv in chunks and only the needed columns,
+        keeping the rows that equal all filters and stopping once
+        the page is full."""
+        usecols = set(columns) | set(filters) | {'trip_id'}
+        chunks = pd.read_csv(os.path.join(self.data_dir, 'trips.csv'),
+                             usecols=usecols, chunksize=CHUNK_SIZE)
+        pages = []
+        found = 0
+        # Trip ids ascend through the csv, so the cursor is unknown
+        # once a later id turns up without it
+        seen = after is None
+        for chunk in chunks:
+            mask = np.ones(len(chunk), dtype=bool)
+            if after is not None:
+                ids = chunk['trip_id'].values
+                seen = seen or bool((ids == after).any())
+                if not seen and len(ids) and ids[-1] > after:
+                    raise SakayDBError('Invalid cursor.')
+                mask &= ids > after
+            for key, val in filters.items():
+                mask &= chunk[key].values == val
+            rows = chunk.loc[mask, columns]
+            skip = min(offset, len(rows))
+            offset -= skip
+            rows = rows.iloc[skip:]
+            if limit is not None:
+                rows = rows.iloc[:limit - found]
+            pages.append(rows)
+            found += len(rows)
+            if limit is not None and found >= limit and seen:
+                break
+        if not seen:
+            raise SakayDBError('Invalid cursor.')
+        if not pages:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(pages, ignore_index=True)
+
+    def _search_trips(self, **kwargs):
+        """Uncached implementation of search_trips."""
+        if self._store is not None:
+            return self._sqlite_search(kwargs)
+
+        if not self._exists('trips.csv'):
             if kwargs == {}:
                 raise SakayDBError
             else:
                 return []
         else:
-            df = pd.read_csv(os.path.join(self.data_dir, 'trips.csv'))
+            df = self._read_trips(compact=False)
 
         df1 = df
         dfp = df1['pickup_datetime']
@@ -305,8 +2274,10 @@ class SakayDB():
                             val1, val2 = val[0], val[1]
 
                         df_vals = (df1.loc[df1[key].between(val1, val2)])
+                        # Ties in trip_id order, as the sqlite backend
+                        # orders them
                         df_merge = (pd.merge(df1, df_vals)
-                                    .sort_values(key_order))
+                                    .sort_values([key_order, 'trip_id']))
 
                         df1 = df_merge
 
@@ -314,24 +2285,16 @@ class SakayDB():
                         key == 'dropoff_datetime'):
 
                     df1['pickup_datetime'] = (
-                        pd.to_datetime(df1['pickup_datetime'],
-                                       format="%H:%M:%S,%d-%m-%Y")
-                                )
+                        _parse_datetimes(df1['pickup_datetime'])[0])
                     df1['dropoff_datetime'] = (
-                        pd.to_datetime(df1['dropoff_datetime'],
-                                       format="%H:%M:%S,%d-%m-%Y"))
+                        _parse_datetimes(df1['dropoff_datetime'])[0])
 
                     if type(val) == str:
 
-                        if type(pd.to_datetime(val, errors='coerce',
-                                format="%H:%M:%S,%d-%m-%Y")) == (
-                                pd._libs.tslibs.nattype.NaTType):
+                        val = _parse_datetime(val)
+                        if val is pd.NaT:
                             raise SakayDBError
 
-                        val = pd.to_datetime(val,
-                                             format="%H:%M:%S,%d-%m-%Y",
-                                             errors='coerce')
-
                         df_vals = df1[df1[key] == val]
                         df_merge = pd.merge(df1, df_vals)
 
@@ -341,40 +2304,26 @@ class SakayDB():
 
                         key_order = key
 
-                        if type(pd.to_datetime(val[0], errors='coerce',
-                                format="%H:%M:%S,%d-%m-%Y")) == (
-                                pd._libs.tslibs.nattype.NaTType):
-                            raise SakayDBError
+                        val1, val2 = [None if v is None
+                                      else _parse_datetime(v) for v in val]
 
-                        elif type(pd.to_datetime(val[1], errors='coerce',
-                                  format="%H:%M:%S,%d-%m-%Y")) == (
-                                  pd._libs.tslibs.nattype.NaTType):
+                        if val1 is pd.NaT or val2 is pd.NaT:
                             raise SakayDBError
 
-                        elif (val[0] is None and
-                                val[1] is None):
+                        elif (val1 is None and
+                                val2 is None):
                             raise SakayDBError
 
-                        elif val[0] is None:
-                            val1, val2 = (
-                                df1[key].min(),
-                                pd.to_datetime(val[1],
-                                               format="%H:%M:%S,%d-%m-%Y"))
-                        elif val[1] is None:
-                            val1, val2 = (
-                                pd.to_datetime(val[0],
-                                               format="%H:%M:%S,%d-%m-%Y"),
-                                df1[key].max())
-                        else:
-                            val1, val2 = (
-                                pd.to_datetime(val[0],
-                                               format="%H:%M:%S,%d-%m-%Y"),
-                                pd.to_datetime(val[1],
-                                               format="%H:%M:%S,%d-%m-%Y"))
+                        elif val1 is None:
+                            val1 = df1[key].min()
+                        elif val2 is None:
+                            val2 = df1[key].max()
 
                         df_vals = df1.loc[df1[key].between(val1, val2)]
+                        # Ties in trip_id order, as the sqlite backend
+                        # orders them
                         df_merge = (pd.merge(df1, df_vals)
-                                    .sort_values(key_order))
+                                    .sort_values([key_order, 'trip_id']))
 
                         df1 = df_merge
 
@@ -384,6 +2333,54 @@ class SakayDB():
 
         return df1
 
+    def _sqlite_search(self, kwargs, limit=None, offset=0, after=None,
+                       columns=None):
+        """search_trips for the sqlite backend. Filters are turned
+        into conditions that sqlite answers from its indexes."""
+        if kwargs == {}:
+            raise SakayDBError
+        if not self._exists('trips.csv'):
+            return []
+
+        where = []
+        params = []
+        order = ['trip_id']
+        for key, val in kwargs.items():
+            if key not in ['driver_id', 'pickup_datetime', 'dropoff_datetime',
+                           'passenger_count', 'trip_distance', 'fare_amount']:
+                raise SakayDBError
+            elif type(val) not in [int, tuple, float, str]:
+                raise SakayDBError
+            elif type(val) == tuple and len(val) != 2:
+                raise SakayDBError
+
+            is_datetime = key in ['pickup_datetime', 'dropoff_datetime']
+            if is_datetime and type(val) in [str, tuple]:
+                dates = [None if v is None else _parse_datetime(v)
+                         for v in (val if type(val) == tuple else [val])]
+                if any(date is pd.NaT for date in dates):
+                    raise SakayDBError
+                dates = [None if date is None else date.strftime(ISO_FORMAT)
+                         for date in dates]
+                val = tuple(dates) if type(val) == tuple else dates[0]
+
+            if type(val) == tuple:
+                if val[0] is None and val[1] is None:
+                    raise SakayDBError
+                if val[0] is not None:
+                    where.append(f'{key} >= ?')
+                    params.append(val[0])
+                if val[1] is not None:
+                    where.append(f'{key} <= ?')
+                    params.append(val[1])
+                order = [key, 'trip_id']
+            elif (type(val) == str) == is_datetime:
+                where.append(f'{key} = ?')
+                params.append(val)
+
+        return self._store.search(where, params, order, columns, limit,
+                                  offset, after)
+
     def export_data(self):
         """
         Merges trips.csv, drivers.csv, locations.csv
@@ -392,31 +2389,23 @@ class SakayDB():
         Returns
         -------
         """
-        if (not os.path.isfile(os.path.join(self.data_dir,
-                                            'trips.csv'))
-                or not os.path.isfile(os.path.join(self.data_dir,
-                                                   'drivers.csv'))
-                or not os.path.isfile(os.path.join(self.data_dir,
-                                                   'locations.csv'))):
+        if not self._exists('trips.csv', 'drivers.csv', 'locations.csv'):
             df = pd.DataFrame(columns=['dropoff_loc_name', 'passenger_count',
                                        'trip_distance', 'dropoff_datetime',
                                        'fare_amount', 'driver_lastname',
                                        'pickup_loc_name', 'driver_givenname',
                                        'pickup_datetime'])
             return df
+        elif self._store is not None:
+            return self._store.export()
         else:
-            trips = pd.read_csv(os.path.join(self.data_dir,
-                                             'trips.csv'))
-            drivers = pd.read_csv(os.path.join(self.data_dir,
-                                               'drivers.csv'))
-            pu_locations = pd.read_csv(os.path.join(self.data_dir,
-                                                    'locations.csv'))
-            do_locations = pd.read_csv(os.path.join(self.data_dir,
-                                                    'locations.csv'))
-            pu_locations.rename(columns={'location_id': 'pickup_loc_id'},
-                                inplace=True)
-            do_locations.rename(columns={'location_id': 'dropoff_loc_id'},
-                                inplace=True)
+            trips = self._read_trips(compact=False)
+            drivers = self._read_drivers()
+            locations = self._read_locations()
+            pu_locations = locations.rename(
+                columns={'location_id': 'pickup_loc_id'})
+            do_locations = locations.rename(
+                columns={'location_id': 'dropoff_loc_id'})
 
             df = pd.merge(trips, drivers, on='driver_id')
             df = (pd.merge(df, pu_locations, on='pickup_loc_id')
@@ -435,7 +2424,164 @@ class SakayDB():
                      'pickup_loc_name', 'driver_givenname', 'pickup_datetime']]
             return df
 
-    def generate_statistics(self, stat):
+    def _columns(self, table, kwargs):
+        """Columns of the export_data, search_trips or
+        generate_odmatrix result as NumPy arrays, with names as
+        categoricals so each distinct name is stored once."""
+        if table == 'export':
+            if not self._exists('trips.csv', 'drivers.csv', 'locations.csv'):
+                return self._frame_columns(self.export_data())
+            trips = self._read_trips(compact=False)
+            drivers = self._read_drivers()
+            locations = self._read_locations()
+            trips = self._known(trips, drivers, locations)
+            trips = trips.sort_values('trip_id')
+            for col in ['pickup_datetime', 'dropoff_datetime']:
+                trips[col] = _parse_datetimes(trips[col])[0]
+            drivers = drivers.set_index('driver_id')
+            loc_names = locations.set_index('location_id')['loc_name']
+            columns = {
+                'dropoff_loc_name': _as_category(trips['dropoff_loc_id'],
+                                                 loc_names),
+                'driver_lastname': _as_category(trips['driver_id'],
+                                                drivers['last_name']),
+                'pickup_loc_name': _as_category(trips['pickup_loc_id'],
+                                                loc_names),
+                'driver_givenname': _as_category(trips['driver_id'],
+                                                 drivers['given_name'])}
+            return {col: columns[col] if col in columns
+                    else trips[col].to_numpy() for col in EXPORT_COLUMNS}
+
+        elif table == 'search':
+            trips = self.search_trips(**kwargs)
+            if isinstance(trips, list):
+                trips = pd.DataFrame(columns=_SQLiteStore.COLUMNS['trips'])
+            return self._frame_columns(trips)
+
+        elif table == 'odmatrix':
+            if kwargs.get('approximate'):
+                raise SakayDBError
+            od = self.generate_odmatrix(**kwargs)
+            return self._frame_columns(
+                od.rename_axis('dropoff_loc_name').reset_index())
+
+        raise SakayDBError
+
+    @staticmethod
+    def _frame_columns(df):
+        """Columns of df as NumPy arrays, with datetime strings
+        parsed and other strings as categoricals."""
+        columns = {}
+        for col in df.columns:
+            values = df[col]
+            if (col in ['pickup_datetime', 'dropoff_datetime']
+                    and values.dtype == object):
+                columns[str(col)] = _parse_datetimes(values)[0]
+            elif values.dtype == object:
+                columns[str(col)] = pd.Categorical(values)
+            else:
+                columns[str(col)] = values.to_numpy()
+        return columns
+
+    def export_numpy(self, table='export', **kwargs):
+        """
+        Returns a result as NumPy column buffers, without building
+        a data frame of Python objects.
+
+        Parameters
+        ----------
+        table : str
+            export : The table of export_data.
+
+            search : The trips found by search_trips(**kwargs).
+
+            odmatrix : The matrix of generate_odmatrix(**kwargs),
+            with the dropoff location names as a column.
+        kwargs
+            Passed to search_trips or generate_odmatrix.
+
+        Returns
+        -------
+        tuple of dict
+            Arrays keyed by column name, and the dictionaries of the
+            name columns, whose arrays hold int codes into them
+            (-1 for missing).
+        """
+        columns = {}
+        dictionaries = {}
+        for col, values in self._columns(table, kwargs).items():
+            if isinstance(values, pd.Categorical):
+                columns[col] = values.codes
+                dictionaries[col] = values.categories.to_numpy()
+            else:
+                columns[col] = values
+        return columns, dictionaries
+
+    def export_arrow(self, table='export', **kwargs):
+        """
+        Returns a result as an Apache Arrow table. Numeric and
+        datetime columns wrap the NumPy buffers without copying and
+        name columns are dictionary encoded. Requires pyarrow.
+
+        Parameters
+        ----------
+        table : str
+            Same as in export_numpy.
+        kwargs
+            Passed to search_trips or generate_odmatrix.
+
+        Returns
+        -------
+        pyarrow.Table
+        """
+        # Optional dependency, only needed for the Arrow export
+        import pyarrow as pa
+
+        arrays = {}
+        for col, values in self._columns(table, kwargs).items():
+            if isinstance(values, pd.Categorical):
+                codes = values.codes
+                indices = (pa.array(codes, mask=codes < 0)
+                           if (codes < 0).any() else pa.array(codes))
+                arrays[col] = pa.DictionaryArray.from_arrays(
+                    indices, pa.array(values.categories.to_numpy()))
+            else:
+                arrays[col] = pa.array(values)
+        return pa.table(arrays)
+
+    def write_arrow_ipc(self, path, table='export', batch_size=65536,
+                        **kwargs):
+        """
+        Writes a result to an Arrow IPC file, in record batches of
+        at most batch_size rows, for hand-off to other processes.
+        Requires pyarrow.
+
+        Parameters
+        ----------
+        path : str
+            File to write.
+        table : str
+            Same as in export_numpy.
+        batch_size : int
+            Maximum number of rows per record batch.
+        kwargs
+            Passed to search_trips or generate_odmatrix.
+
+        Returns
+        -------
+        int
+            Number of rows written.
+        """
+        import pyarrow as pa
+
+        result = self.export_arrow(table, **kwargs)
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, result.schema) as writer:
+                writer.write_table(result, max_chunksize=batch_size)
+        return result.num_rows
+
+    def generate_statistics(self, stat, approximate=False, error=0.05,
+                            window=None, as_of=None, chunksize=None):
         """
         Function will generate different
         statistics based on the stat
@@ -455,214 +2601,489 @@ class SakayDB():
 
             all : Keys for dict are trip, passenger,
             and driver with the corresponding stat.
+        approximate : bool
+            If True, the stats are estimated from a stratified
+            sample with a bounded number of trips per day, so
+            the cost does not grow with the number of trips.
+        error : float
+            Target sampling error of the approximate stats, as
+            a proportion of each day's trips. Smaller values
+            keep more trips per day.
+        window : str or int, optional
+            Restricts the stats to the trips of the last window
+            days up to as_of, e.g. '28D' or 28. Windows are kept
+            as running sums, so moving one forward only costs the
+            days that enter and leave it.
+        as_of : str or datetime, optional
+            Last day of the window, as a datetime string or a
+            datetime. Defaults to today.
+        chunksize : int, optional
+            If given, trips.csv is read chunksize rows at a time and
+            only the per-day counts are kept in memory, for data
+            that does not fit in memory. The sqlite backend already
+            aggregates without loading the trips.
 
         Returns
         -------
         dict
-            Dictionary containing the required stats.
+            Dictionary containing the required stats. If
+            approximate, a tuple of the estimated stats and a
+            dictionary of the same shape holding the half-width
+            of the 95% confidence interval of each estimate.
         """
-        if (not os.path.isfile(os.path.join(self.data_dir,
-                                            'trips.csv'))
-            or not os.path.isfile(os.path.join(self.data_dir,
-                                               'drivers.csv'))
-            or not os.path.isfile(os.path.join(self.data_dir,
-                                               'locations.csv'))):
-
+        if approximate and not 0 < error < 1:
+            raise SakayDBError
+        self._check_chunksize(chunksize, approximate, window)
+        if window is not None:
+            if approximate:
+                raise SakayDBError
+            length, end = self._window_bounds(window, as_of)
+        if not self._exists('trips.csv', 'drivers.csv', 'locations.csv'):
             if stat in ['trip', 'passenger', 'driver']:
-                return {}
+                empty = {}
             elif stat == 'all':
-                return {'trip': {}, 'passenger': {}, 'driver': {}}
+                empty = {'trip': {}, 'passenger': {}, 'driver': {}}
             else:
                 raise SakayDBError
-        trips = pd.read_csv(os.path.join(self.data_dir,
-                                         'trips.csv'))
-        drivers = pd.read_csv(os.path.join(self.data_dir,
-                                           'drivers.csv'))
-        pu_locations = pd.read_csv(os.path.join(self.data_dir,
-                                                'locations.csv'))
-        do_locations = pd.read_csv(os.path.join(self.data_dir,
-                                                'locations.csv'))
-        pu_locations.rename(columns={'location_id': 'pickup_loc_id'},
-                            inplace=True)
-        do_locations.rename(columns={'location_id': 'dropoff_loc_id'},
-                            inplace=True)
-
-        df = pd.merge(trips, drivers, on='driver_id')
-        df = (pd.merge(df, pu_locations, on='pickup_loc_id')
-              .rename(columns={'loc_name': 'pickup_loc_name'}))
-        df = (pd.merge(df, do_locations, on='dropoff_loc_id')
-              .rename(columns={'loc_name': 'dropoff_loc_name'}))
-        df.rename(columns={
-                'last_name': 'driver_lastname',
-                'given_name': 'driver_givenname'
-            }, inplace=True)
-        df = df[['trip_id',
-                 'driver_lastname',
-                 'driver_givenname',
-                 'pickup_datetime',
-                 'dropoff_datetime',
-                 'passenger_count',
-                 'pickup_loc_name',
-                 'dropoff_loc_name',
-                 'trip_distance',
-                 'fare_amount']]
-
-        df.pickup_datetime = (pd.to_datetime(df.pickup_datetime,
-                                             format='%H:%M:%S,%d-%m-%Y'))
-        df.dropoff_datetime = (pd.to_datetime(df.dropoff_datetime,
-                                              format='%H:%M:%S,%d-%m-%Y'))
-
-        df['day'] = df['pickup_datetime'].dt.day_name()
-        dfc = df.copy()
-
-        # para case insensitive:
-        dfc['day'] = dfc['day'].str.title()
-        dfc['driver'] = (dfc['driver_lastname']
-                         .str.title() +
-                         ', ' +
-                         dfc['driver_givenname']
-                         .str.title())
-
-        week = ['Monday', 'Tuesday',
-                'Wednesday', 'Thursday',
-                'Friday', 'Saturday', 'Sunday']
-        if ((stat != 'trip') &
-                (stat != 'passenger') &
-                (stat != 'driver') &
-                (stat != 'all')):
+            return (empty, {k: {} for k in empty}) if approximate else empty
+        if stat not in ['trip', 'passenger', 'driver', 'all']:
             raise SakayDBError
 
-        elif stat == 'trip':
-            trip_ = {}
-            for w in week:
-                dfc_filter = (dfc.groupby(['day',
-                                           pd.Grouper(key='pickup_datetime',
-                                                      freq='D')])
-                              ['trip_id']
-                              .count().reset_index())
-                dfc_filter_trip = dfc_filter.groupby('day')['trip_id'].mean()
-                trip = {w: dfc_filter_trip[w]}
-                trip_.update(**trip)
-            return trip_
+        if approximate:
+            return self._approximate_statistics(stat, error)
+        if window is not None:
+            return self._window_statistics(stat, length, end)
+        if self._store is not None:
+            return self._sqlite_statistics(stat)
+        if chunksize is not None:
+            return self._chunked_statistics(stat, chunksize)
+
+        dfc = self._stats_frame()
+
+        if stat == 'trip':
+            return self._trip_stats(dfc)
 
         elif stat == 'passenger':
-            number = dfc['passenger_count'].unique()
-            number = np.sort(number)
-            passenger_ = {}
-            daily_ = {}
-            for n in number:
-                # Filter df by unique passenger count
-                dfc_filter = dfc.loc[dfc['passenger_count'] == n]
-                # Daily bins
-                dfc_filter = (dfc_filter
-                              .groupby(['day',
-                                        pd.Grouper(key='pickup_datetime',
-                                                   freq='D')])
-                              .count()
-                              .reset_index())
-                # Get mean by day name
-                dfc_filter_pass = (dfc_filter
-                                   .groupby('day')
-                                   ['passenger_count']
-                                   .mean()
-                                   .reindex(week))
-                # Convert to dictionary
-                daily_ = dfc_filter_pass.to_dict()
-                daily_.update(daily_, **daily_)
-                passenger_[n] = daily_
-            return passenger_
+            return self._weekday_stats(dfc, 'passenger_count')
 
         elif stat == 'driver':
-            name = dfc['driver'].unique()
-            driver_ = {}
-            daily_ = {}
-            for n in name:
-                # Filter by driver name
-                dfc_filter = dfc.loc[dfc['driver'] == n]
-                # Daily bins
-                dfc_filter = (dfc_filter
-                              .groupby(['day',
-                                        pd.Grouper(key='pickup_datetime',
-                                                   freq='D')])
-                              .count()
-                              .reset_index())
-                # Get mean by day name
-                dfc_filter_driver = (dfc_filter
-                                     .groupby('day')
-                                     ['driver']
-                                     .mean().reindex(week))
-                daily_ = dfc_filter_driver.to_dict()
-                daily_.update(daily_, **daily_)
-                driver_[n] = daily_
-            return driver_
+            return self._weekday_stats(dfc, 'driver')
 
         elif stat == 'all':
-            trip_ = {}
-            for w in week:
-                dfc_filter = (dfc
-                              .groupby(['day',
-                                        pd.Grouper(key='pickup_datetime',
-                                                   freq='D')])
-                              ['trip_id']
-                              .count()
-                              .reset_index())
-                dfc_filter_trip = dfc_filter.groupby('day')['trip_id'].mean()
-                trip = {w: dfc_filter_trip[w]}
-                trip_.update(**trip)
-
-            number = dfc['passenger_count'].unique()
-            number = np.sort(number)
-            passenger_ = {}
-            daily_ = {}
-            for n in number:
-                # Filter df by unique passenger count
-                dfc_filter = dfc.loc[dfc['passenger_count'] == n]
-                # Daily bins
-                dfc_filter = (dfc_filter
-                              .groupby(['day',
-                                        pd.Grouper(key='pickup_datetime',
-                                                   freq='D')])
-                              .count()
-                              .reset_index())
-                # Get mean by day name
-                dfc_filter_pass = (dfc_filter
-                                   .groupby('day')
-                                   ['passenger_count']
-                                   .mean()
-                                   .reindex(week))
-                # Convert to dictionary
-                daily_ = dfc_filter_pass.to_dict()
-                daily_.update(daily_, **daily_)
-                passenger_[n] = daily_
-
-            name = dfc['driver'].unique()
-            driver_ = {}
-            daily_ = {}
-            for n in name:
-                # Filter by driver name
-                dfc_filter = dfc.loc[dfc['driver'] == n]
-                # Daily bins
-                dfc_filter = (dfc_filter
-                              .groupby(['day',
-                                        pd.Grouper(key='pickup_datetime',
-                                                   freq='D')])
-                              .count()
-                              .reset_index())
-                # Get mean by day name
-                dfc_filter_driver = (dfc_filter
-                                     .groupby('day')['driver']
-                                     .mean()
-                                     .reindex(week))
-                daily_ = dfc_filter_driver.to_dict()
-                daily_.update(daily_, **daily_)
-                driver_[n] = daily_
-
-            dict_all = {'trip': trip_,
-                        'passenger': passenger_,
-                        'driver': driver_}
+            dict_all = {'trip': self._trip_stats(dfc),
+                        'passenger': self._weekday_stats(dfc,
+                                                         'passenger_count'),
+                        'driver': self._weekday_stats(dfc, 'driver')}
             return dict_all
 
-    def plot_statistics(self, stat):
+    def _driver_names(self, drivers=None):
+        """Returns the driver names, building them again from
+        drivers, or from drivers.csv if not given, if the data
+        changed other than through add_trip."""
+        version = self._data_version()
+        if self._names is None or self._names.version != version:
+            if drivers is None:
+                drivers = self._read_drivers()
+            self._names = _DriverNames(drivers, version)
+        return self._names
+
+    def _names_add(self, version, driver_id, given_name, last_name):
+        """Adds the driver of a trip written at version to the
+        driver names if it is new."""
+        if self._names is None or self._names.version != version:
+            return
+        self._names.add(driver_id, given_name, last_name)
+        self._names.version = self._data_version()
+
+    @staticmethod
+    def _known(trips, drivers, locations):
+        """Drops trips with unknown drivers or locations as the
+        inner merges with drivers.csv and locations.csv would."""
+        keep = (trips['driver_id'].isin(drivers['driver_id']) &
+                trips['pickup_loc_id'].isin(locations['location_id']) &
+                trips['dropoff_loc_id'].isin(locations['location_id']))
+        return trips if keep.all() else trips.loc[keep]
+
+    def _stats_frame(self):
+        """Loads only the columns that the statistics need. Day and
+        driver are categorical so each name is stored once."""
+        trips = self._read_trips(usecols=['driver_id',
+                                          'pickup_datetime',
+                                          'passenger_count',
+                                          'pickup_loc_id',
+                                          'dropoff_loc_id'])
+        drivers = self._read_drivers()
+        trips = self._known(trips, drivers, self._read_locations())
+
+        pickup = trips['pickup_datetime']
+        return pd.DataFrame({
+            'date': pickup.dt.floor('D'),
+            'day': pd.Categorical.from_codes(pickup.dt.dayofweek, WEEK),
+            'passenger_count': trips['passenger_count'],
+            'driver': _as_category(trips['driver_id'],
+                                   self._driver_names(drivers).names)
+        }, index=trips.index)
+
+    @staticmethod
+    def _daily_means(dfc, key=None):
+        """Average number of trips per day of week, taken over the
+        days with at least one trip, optionally split by key."""
+        keys = ['day', 'date'] if key is None else [key, 'day', 'date']
+        # Daily bins
+        daily = dfc.groupby(keys, observed=True).size()
+        # Get mean by day name
+        return daily.groupby(level=keys[:-1], observed=True).mean()
+
+    def _trip_stats(self, dfc):
+        """Average number of trips per day of week."""
+        means = self._daily_means(dfc)
+        return {w: means[w] for w in WEEK}
+
+    def _weekday_stats(self, dfc, key):
+        """Average number of trips per day of week for each value
+        of key, as a dict of dicts keyed by value then day name."""
+        return self._weekday_dict(self._daily_means(dfc, key))
+
+    @staticmethod
+    def _weekday_dict(means):
+        """Turns a series indexed by value and day into a dict of
+        dicts keyed by value then day name."""
+        means = means.unstack('day').reindex(columns=WEEK)
+        return {n: row.to_dict() for n, row in means.iterrows()}
+
+    @staticmethod
+    def _check_chunksize(chunksize, approximate, window):
+        """Validates the chunksize of generate_statistics and
+        generate_odmatrix."""
+        if chunksize is None:
+            return
+        if type(chunksize) != int or chunksize <= 0:
+            raise SakayDBError('Invalid chunksize.')
+        if approximate or window is not None:
+            raise SakayDBError
+
+    def _trip_chunks(self, usecols, chunksize):
+        """Reads trips.csv chunksize rows at a time using the
+        compact schema. Inside a batch, the trips are already in
+        memory and come as one chunk."""
+        if self._batch is not None:
+            yield self._read_trips(usecols=usecols)
+            return
+        dtype = dict(TRIPS_KEY_DTYPES, **TRIPS_METRIC_DTYPES)
+        chunks = pd.read_csv(os.path.join(self.data_dir, 'trips.csv'),
+                             usecols=usecols, chunksize=chunksize)
+        for chunk in chunks:
+            chunk = _downcast(chunk, dtype)
+            for col in ['pickup_datetime', 'dropoff_datetime']:
+                if col in chunk.columns:
+                    chunk[col] = _parse_datetimes(chunk[col])[0]
+            yield chunk
+
+    @staticmethod
+    def _count_means(daily):
+        """Average of daily counts indexed by key and date, per key
+        and day of week, as _daily_means takes them."""
+        dates = daily.index.get_level_values('date')
+        day = pd.CategoricalIndex(
+            pd.Categorical.from_codes(dates.dayofweek, WEEK), name='day')
+        keys = [daily.index.get_level_values(name)
+                for name in daily.index.names[:-1]]
+        return daily.groupby(keys + [day], observed=True).mean()
+
+    def _means_by_name(self, daily, drivers=None):
+        """_count_means of daily counts indexed by driver_id and
+        date, with the drivers that share a display name counted as
+        one, as _stats_frame tells them apart."""
+        names = self._driver_names(drivers).names
+        ids = daily.index.get_level_values('driver_id')
+        daily = daily.groupby(
+            [pd.Index(names.reindex(ids).values, name='driver'),
+             daily.index.get_level_values('date')]).sum()
+        return self._count_means(daily)
+
+    def _chunked_statistics(self, stat, chunksize):
+        """Computes generate_statistics from per-day counts summed
+        over chunks of trips.csv."""
+        drivers = self._read_drivers()
+        locations = self._read_locations()
+        kinds = [kind for kind in ['trip', 'passenger', 'driver']
+                 if stat in [kind, 'all']]
+        counts = _ChunkCounts(kinds)
+        for trips in self._trip_chunks(['driver_id', 'pickup_datetime',
+                                        'passenger_count', 'pickup_loc_id',
+                                        'dropoff_loc_id'], chunksize):
+            counts.add(self._known(trips, drivers, locations))
+        result = {}
+
+        if 'trip' in kinds:
+            means = self._count_means(counts.counts['trip'])
+            result['trip'] = {w: means[w] for w in WEEK}
+
+        if 'passenger' in kinds:
+            result['passenger'] = self._weekday_dict(
+                self._count_means(counts.counts['passenger']))
+
+        if 'driver' in kinds:
+            result['driver'] = self._weekday_dict(
+                self._means_by_name(counts.counts['driver'], drivers))
+
+        if stat == 'all':
+            return result
+        return result[stat]
+
+    def _day_sample(self, error):
+        """Returns the stratified day sample, drawing it again if
+        the data changed other than through add_trip or if it is
+        too small for the target error."""
+        # Sample size that bounds the error of a proportion
+        k = int(np.ceil((Z_95 / error) ** 2 / 4))
+        version = self._data_version()
+        if (self._sample is None or self._sample.k < k
+                or self._sample.version != version):
+            trips = self._read_trips(usecols=_DaySample.COLUMNS)
+            trips = self._known(trips, self._read_drivers(),
+                                self._read_locations())
+            self._sample = _DaySample(trips, k, version)
+        return self._sample
+
+    def _driver_counts(self):
+        """Returns the per driver counts, taking them again if the
+        data changed other than through add_trip."""
+        version = self._data_version()
+        if self._counts is None or self._counts.version != version:
+            trips = self._read_trips(usecols=['driver_id',
+                                              'pickup_datetime',
+                                              'pickup_loc_id',
+                                              'dropoff_loc_id'])
+            trips = self._known(trips, self._read_drivers(),
+                                self._read_locations())
+            self._counts = _DriverCounts(trips, version)
+        return self._counts
+
+    def _synopses_add(self, row, version):
+        """Adds a trip written at version to the day sample and the
+        driver counts instead of rebuilding them on the next query."""
+        synopses = [synopsis for synopsis in [self._sample, self._counts,
+                                              self._day_counts]
+                    if synopsis is not None and synopsis.version == version]
+        if not synopses:
+            return
+        trip = {
+            'pickup_datetime': _parse_datetime(row['pickup_datetime']),
+            'dropoff_datetime': _parse_datetime(row['dropoff_datetime']),
+            'driver_id': row['driver_id'],
+            'passenger_count': row['passenger_count'],
+            'pickup_loc_id': row['pickup_loc_id'],
+            'dropoff_loc_id': row['dropoff_loc_id']}
+        if (trip['pickup_datetime'] is pd.NaT
+                or trip['dropoff_datetime'] is pd.NaT):
+            self._sample = None
+            self._counts = None
+            self._day_counts = None
+            return
+        version = self._data_version()
+        for synopsis in synopses:
+            synopsis.add(trip)
+            synopsis.version = version
+
+    @staticmethod
+    def _window_bounds(window, as_of):
+        """Validates window and as_of and returns the length of the
+        window in days and its last day."""
+        try:
+            if isinstance(window, str):
+                length = pd.Timedelta(window)
+            else:
+                length = pd.Timedelta(days=window)
+        except (ValueError, TypeError):
+            raise SakayDBError('Invalid window.')
+        if length <= pd.Timedelta(0) or length % pd.Timedelta(days=1):
+            raise SakayDBError('Invalid window.')
+
+        if as_of is None:
+            end = pd.Timestamp.now()
+        elif isinstance(as_of, str):
+            end = _parse_datetime(as_of)
+        else:
+            end = pd.to_datetime(as_of, errors='coerce')
+        if not isinstance(end, pd.Timestamp) or end is pd.NaT:
+            raise SakayDBError('Invalid as_of.')
+        return length.days, end.floor('D')
+
+    def _window(self, length, end):
+        """Returns the window of length days over the day counts,
+        moved so that it ends on end."""
+        version = self._data_version()
+        if self._day_counts is None or self._day_counts.version != version:
+            trips = self._read_trips(usecols=_DaySample.COLUMNS)
+            trips = self._known(trips, self._read_drivers(),
+                                self._read_locations())
+            self._day_counts = _DayCounts(trips, version)
+        window = self._day_counts.window(length)
+        window.advance(end)
+        return window
+
+    def _window_statistics(self, stat, length, end):
+        """Computes generate_statistics over a window of days."""
+        window = self._window(length, end)
+        result = {}
+
+        if stat in ['trip', 'all']:
+            means = window.means('trip')
+            result['trip'] = {w: means.get((None, i), np.nan)
+                              for i, w in enumerate(WEEK)}
+
+        for name, kind in [('passenger', 'passenger'), ('driver', 'driver')]:
+            if stat not in [name, 'all']:
+                continue
+            means = window.means(kind)
+            if not means:
+                result[name] = {}
+                continue
+            if kind == 'driver' and not self._driver_names().names.is_unique:
+                # The running sums cannot merge drivers that share a
+                # name, so count their days in the window again
+                daily = pd.Series({
+                    (driver_id, date): n for date in window.dates
+                    for driver_id, n in window.counts.days.get(
+                        date, {}).get('driver', {}).items()})
+                daily.index.names = ['driver_id', 'date']
+                result[name] = self._weekday_dict(self._means_by_name(daily))
+                continue
+            means = pd.Series(means)
+            means.index.names = [kind, 'day']
+            if kind == 'driver':
+                names = self._driver_names().names
+                means = means.rename(index=names.to_dict(), level='driver')
+            means = means.rename(index=dict(enumerate(WEEK)), level='day')
+            result[name] = self._weekday_dict(means)
+
+        if stat == 'all':
+            return result
+        return result[stat]
+
+    def _sqlite_statistics(self, stat):
+        """Computes generate_statistics as GROUP BYs in sqlite."""
+        result = {}
+        if stat in ['trip', 'all']:
+            means = self._store.weekday_means()
+            result['trip'] = {w: means[w] for w in WEEK}
+        for name, key in [('passenger', 'passenger_count'),
+                          ('driver', 'driver_id')]:
+            if stat not in [name, 'all']:
+                continue
+            if (key == 'driver_id'
+                    and not self._driver_names().names.is_unique):
+                # Drivers that share a name are merged by date first
+                result[name] = self._weekday_dict(
+                    self._means_by_name(self._store.daily_counts(key)))
+                continue
+            means = self._store.weekday_means(key)
+            if key == 'driver_id':
+                names = self._driver_names().names
+                means = means.rename(index=names.to_dict(), level=key)
+            result[name] = self._weekday_dict(means)
+
+        if stat == 'all':
+            return result
+        return result[stat]
+
+    def _approximate_statistics(self, stat, error):
+        """Estimates generate_statistics from the day sample."""
+        sample = self._day_sample(error)
+        result = {}
+        bounds = {}
+
+        days = sample.day_counts
+        totals = {w: days.values[days.index.dayofweek == i]
+                  for i, w in enumerate(WEEK)}
+        sampled = {w: n > sample.k for w, n in totals.items()}
+
+        if stat in ['trip', 'all']:
+            # Daily totals are exact so only their mean is needed
+            means = (days.groupby(days.index.dayofweek).mean()
+                     .reindex(range(len(WEEK))))
+            result['trip'] = dict(zip(WEEK, means.values))
+            bounds['trip'] = dict.fromkeys(WEEK, 0.0)
+
+        for name, key in [('passenger', 'passenger_count'),
+                          ('driver', 'driver')]:
+            if stat not in [name, 'all']:
+                continue
+            if key == 'driver':
+                values = _as_category(
+                    sample.sample['driver_id'],
+                    self._driver_names().names)
+            else:
+                values = sample.sample[key]
+            daily = sample.daily_estimates({key: values})
+            daily['day'] = pd.Categorical.from_codes(
+                daily['date'].dt.dayofweek, WEEK)
+            mean, bound = _mean_estimates(daily, [key, 'day'], totals,
+                                          sampled, 'day')
+            result[name] = self._weekday_dict(mean)
+            bounds[name] = self._weekday_dict(bound)
+
+        if stat == 'all':
+            return result, bounds
+        return result[stat], bounds[stat]
+
+    def top_drivers(self, k=5, by='weekday', metric='mean'):
+        """
+        Ranks the drivers with the most trips using partial
+        selection over incrementally maintained per driver counts,
+        without sorting every driver.
+
+        Parameters
+        ----------
+        k : int
+            Number of drivers to return.
+        by : str
+            weekday : Ranks the drivers separately for each day
+            of week.
+
+            all : Ranks the drivers over all days.
+        metric : str
+            mean : Average number of trips per day, over the days
+            with trips, as in generate_statistics.
+
+            trips : Total number of trips.
+
+        Returns
+        -------
+        dict
+            Driver names mapped to the metric, highest first with
+            ties broken by name. For weekday, keyed by day name
+            first.
+        """
+        if (by not in ['weekday', 'all'] or metric not in ['mean', 'trips']
+                or type(k) != int or k < 0):
+            raise SakayDBError
+        if not self._exists('trips.csv', 'drivers.csv', 'locations.csv'):
+            return {}
+
+        counts = self._driver_counts()
+        counts = counts.by_name(self._driver_names().names
+                                .reindex(counts.ids).values)
+        names = counts.ids.values
+        if by == 'all':
+            trips = counts.trips.sum(axis=1)
+            if metric == 'mean':
+                values = trips / np.maximum(counts.days.sum(axis=1), 1)
+            else:
+                values = trips.astype(float)
+            values[trips == 0] = np.nan
+            top = _top_k(values, names, k)
+            return dict(zip(names[top], values[top]))
+
+        values = counts.values(metric)
+        top_ = {}
+        for i, w in enumerate(WEEK):
+            top = _top_k(values[:, i], names, k)
+            top_[w] = dict(zip(names[top], values[top, i]))
+        return top_
+
+    def plot_statistics(self, stat, format=None, stats=None):
         """
         This method takes in a string input as the stat parameter.
 
@@ -676,13 +3097,24 @@ class SakayDB():
         stat
             trip:
                 When the parameter is set to 'trip', the method will show
-                the average number of trips per day of week.
+                the average number of trips per day of week, taken as
+                generate_statistics takes it over the days with trips.
             passenger:
                 When the parameter is set to 'passenger', the method will show
                 the average passenger count per day.
             driver:
                 When the parameter is set to 'driver', the method will show
                 the drivers with the top average trips per day.
+        format
+            'png' or 'svg' to render the plot to image bytes instead,
+            on a figure that does not go through pyplot, so plots can
+            be rendered without a display, and from several threads
+            as long as each uses its own SakayDB.
+        stats
+            Result of generate_statistics(stat) or
+            generate_statistics('all') to plot, instead of computing
+            it again. Not used for 'driver', which plots the per
+            driver counts of top_drivers.
 
         Returns
         ----------
@@ -690,56 +3122,32 @@ class SakayDB():
             depending on the stat parameter passed to it:
             trip: bar plot
             passenger: line plots
-            driver: bar plots"""
+            driver: bar plots
+            or the image as bytes if format is given."""
+        if stat not in ['trip', 'passenger', 'driver']:
+            raise SakayDBError
+        if format not in [None, 'png', 'svg']:
+            raise SakayDBError('Invalid format.')
+
+        # matplotlib is only imported when plotting; rendered plots
+        # use the Agg or SVG canvas directly
+        if format is None:
+            import matplotlib.pyplot as plt
+            new_figure = plt.figure
+        else:
+            from matplotlib.figure import Figure as new_figure
+
+        if stat in ['trip', 'passenger']:
+            if stats is None:
+                stats = self.generate_statistics(stat)
+            elif 'trip' in stats and 'driver' in stats:
+                stats = stats[stat]
 
         if stat == 'trip':
-            df_trips = (
-                pd.read_csv(os.path.join(self.data_dir, 'trips.csv'))
-            )
-
-            df_trips['pickup_datetime'] = (
-                pd.to_datetime(df_trips['pickup_datetime'],
-                               format='%X,%d-%m-%Y')
-            )
-
-            df_trips_new = (
-                df_trips.groupby('pickup_datetime')
-                ['trip_id'].nunique().reset_index()
-            )
-
-            df_trips_new.set_index('pickup_datetime', inplace=True)
-            df_trips_fin = df_trips_new.resample('D').sum().reset_index()
-
-            df_trips_fin['day_of_week'] = (
-                df_trips_fin['pickup_datetime'].dt.day_name()
-            )
-
-            df_trips_mean = (
-                df_trips_fin.groupby('day_of_week')
-                ['trip_id'].mean().reset_index()
-            )
-
-            days_in_nums = {'Monday': 0, 'Tuesday': 1,
-                            'Wednesday': 2, 'Thursday': 3,
-                            'Friday': 4, 'Saturday': 5, 'Sunday': 6}
-
-            df_trips_mean['days_in_nums'] = (
-                df_trips_mean['day_of_week'].map(days_in_nums)
-            )
-
-            df_trips_sorted = (
-                df_trips_mean.sort_values(by=['days_in_nums'],
-                                          ascending=True)
-            )
-
-            df_trips_sorted.drop("days_in_nums",
-                                 axis=1, inplace=True)
-            df_trips_sorted.set_index('day_of_week', inplace=True)
-
-            graph = (
-                df_trips_sorted.plot(legend=None,
-                                     kind='bar', figsize=(12, 8))
-            )
+            fig = new_figure(figsize=(12, 8))
+            graph = fig.subplots()
+            graph.bar(WEEK, [stats[w] for w in WEEK], width=0.5)
+            graph.tick_params(axis='x', labelrotation=90)
 
             y_range = [0, 5, 10, 15, 20, 25, 30, 35, 40, 45]
             y_range1 = ['0', '5', '10', '15', '20',
@@ -750,155 +3158,54 @@ class SakayDB():
             graph.set_title('Average trips per day')
             graph.set_ylabel('Ave Trips')
             graph.set_xlabel('Day of week')
-            plt.show()
-            return graph
+            result = graph
 
         elif stat == 'passenger':
-            df_trips = (
-                pd.read_csv(os.path.join(self.data_dir, 'trips.csv'))
-            )
-
-            df_trips['pickup_datetime'] = (
-                pd.to_datetime(df_trips['pickup_datetime'],
-                               format='%X,%d-%m-%Y')
-            )
-
-            df_trial = (
-                df_trips.groupby(['pickup_datetime', 'passenger_count'])
-                ['trip_id'].nunique()
-            )
-
-            df_trial1 = (
-                df_trial.groupby(
-                    [pd.Grouper(level='passenger_count'),
-                     pd.Grouper(level='pickup_datetime',
-                                freq='D')]).sum().reset_index()
-            )
-
-            df_trial1['day_of_week'] = (
-                df_trial1['pickup_datetime'].dt.day_name()
-            )
-
-            df_fin = (
-                df_trial1.groupby(['passenger_count', 'day_of_week'])
-                ['trip_id'].mean().reset_index()
-            )
-
-            days_in_nums = {'Monday': 0, 'Tuesday': 1,
-                            'Wednesday': 2, 'Thursday': 3,
-                            'Friday': 4, 'Saturday': 5, 'Sunday': 6}
-
-            df_fin['days_in_nums'] = (
-                df_fin['day_of_week'].map(days_in_nums)
-            )
-
-            df_fin.set_index(['passenger_count',
-                              'day_of_week', 'days_in_nums'],
-                             inplace=True)
-
-            df_final = (
-                df_fin.sort_index(level='days_in_nums').reset_index()
-            )
-
-            df_final.drop("days_in_nums",
-                          axis=1, inplace=True)
-
-            df_final.set_index(['passenger_count',
-                                'day_of_week'], inplace=True)
-
-            fig, ax = plt.subplots(figsize=(12, 8))
-
-            number = df_trial1['passenger_count'].unique()
-            number = np.sort(number)
-
-            for i in range(len(number)):
-                ax.plot(df_final.loc[i], marker='o', label=i)
-                ax.set_yticks([9.0, 9.25, 9.5, 9.75, 10.0, 10.25,
-                               10.5, 10.75, 11.0, 11.25, 11.5])
-                ax.set_xlabel('Day of week')
-                ax.set_ylabel('Ave Trips')
-                ax.legend()
-                fig.canvas.draw()
-
-            return ax
+            fig = new_figure(figsize=(12, 8))
+            ax = fig.subplots()
+
+            for count in sorted(stats):
+                days = [w for w in WEEK if not np.isnan(stats[count][w])]
+                ax.plot(days, [stats[count][w] for w in days],
+                        marker='o', label=count)
+            ax.set_yticks([9.0, 9.25, 9.5, 9.75, 10.0, 10.25,
+                           10.5, 10.75, 11.0, 11.25, 11.5])
+            ax.set_xlabel('Day of week')
+            ax.set_ylabel('Ave Trips')
+            ax.legend()
+            result = ax
 
         elif stat == 'driver':
-            df_trips = (
-                pd.read_csv(os.path.join(self.data_dir, 'trips.csv'))
-            )
-
-            df_drivers = (
-                pd.read_csv(os.path.join(self.data_dir, 'drivers.csv'))
-            )
-
-            df_trips['pickup_datetime'] = (
-                pd.to_datetime(df_trips['pickup_datetime'],
-                               format='%X,%d-%m-%Y')
-            )
-
-            df_drivers["full_name"] = (
-                df_drivers["given_name"] + ' ' + df_drivers["last_name"]
-            )
-
-            names = dict(zip(df_drivers['driver_id'], df_drivers['full_name']))
-
-            df_driv = (
-                df_trips.groupby(['pickup_datetime', 'driver_id'])
-                ['trip_id'].nunique()
-            )
-
-            df_driv1 = (
-                df_driv.groupby([pd.Grouper(level='driver_id'),
-                                 pd.Grouper(level='pickup_datetime',
-                                            freq='D')]).sum().reset_index()
-            )
-
-            df_driv1['day_of_week'] = (
-                df_driv1['pickup_datetime'].dt.day_name()
-            )
-
-            df_driv2 = (
-                df_driv1.groupby(['driver_id', 'day_of_week'])
-                ['trip_id'].mean().reset_index()
-            )
-
-            days_in_nums = {'Monday': 0, 'Tuesday': 1,
-                            'Wednesday': 2, 'Thursday': 3,
-                            'Friday': 4, 'Saturday': 5, 'Sunday': 6}
-
-            df_driv2['days_in_nums'] = (
-                df_driv2['day_of_week'].map(days_in_nums)
-            )
-
-            df_driv2['driver'] = df_driv2['driver_id'].map(names)
-            df_driv3 = (
-                df_driv2.sort_values([
-                    'days_in_nums', 'trip_id', 'driver'],
-                    ascending=[True, False, True]).reset_index(drop=True)
-            )
-
-            df_driv3.set_index(['days_in_nums'], inplace=True)
+            counts = self._driver_counts()
+
+            names = (self._driver_names().full_names
+                     .reindex(counts.ids).values)
+            means = counts.values('mean')
 
             row_count = 7
             column_count = 1
             h_space = 0.2
-            fig, ax = plt.subplots(row_count, column_count,
-                                   figsize=(8, 25), sharex=True)
+            fig = new_figure(figsize=(8, 25))
+            ax = fig.subplots(row_count, column_count, sharex=True)
             fig.subplots_adjust(hspace=h_space)
 
             for i in range(row_count):
-                ax[i].barh(df_driv3.loc[i].head(5)['driver'],
-                           df_driv3.loc[i].head(5)['trip_id'],
-                           label=df_driv3['day_of_week'].unique()[i])
+                top = _top_k(means[:, i], names, 5)
+                ax[i].barh(names[top], means[top, i], label=WEEK[i])
                 ax[i].legend()
                 ax[i].invert_yaxis()
+            result = fig
 
+        if format is None:
             fig.canvas.draw()
-            return fig
-        else:
-            raise SakayDBError
-
-    def generate_odmatrix(self, date_range=(None, None)):
+            return result
+        image = io.BytesIO()
+        fig.savefig(image, format=format)
+        return image.getvalue()
+
+    def generate_odmatrix(self, date_range=(None, None), approximate=False,
+                          error=0.05, window=None, as_of=None,
+                          chunksize=None):
         """Create a method generate_odmatrix that takes in a date_range input
         parameter and returns a pandas.DataFrame with the trips.csv
         pickup_loc_name as the row names (dataframe index) and dropoff_loc_name
@@ -922,6 +3229,21 @@ class SakayDB():
 
             Input errors to the date_range parameter should be handled like
             that of search_trips.
+        approximate
+            If True, the averages are estimated from the stratified day
+            sample used by generate_statistics instead of a full scan.
+        error
+            Target sampling error of the approximate averages, as in
+            generate_statistics.
+        window
+            Restricts the averages to the last window days up to as_of,
+            as in generate_statistics. Cannot be combined with date_range.
+        as_of
+            Last day of the window. Defaults to today.
+        chunksize
+            If given, trips.csv is read chunksize rows at a time and
+            only the daily counts of each pair are kept in memory, as
+            in generate_statistics.
 
         Returns
         -------
@@ -930,9 +3252,25 @@ class SakayDB():
             the row names (dataframe index) and dropoff_loc_name as the
             columns. The values for each row-column combination is the average
             daily number of trips that occured within the date_range
-            specified.
+            specified. If approximate, a tuple of the estimated matrix and
+            a matrix of the half-widths of their 95% confidence intervals.
 
         """
+        self._check_chunksize(chunksize, approximate, window)
+        if window is not None:
+            if approximate or tuple(date_range) != (None, None):
+                raise SakayDBError
+            window = self._window_bounds(window, as_of)
+        # Chunked or not, the result is the same
+        key = ('generate_odmatrix', date_range, approximate, error, window)
+        return self._cached(key, lambda: self._generate_odmatrix(
+            date_range, approximate, error, window, chunksize))
+
+    def _generate_odmatrix(self, date_range, approximate, error, window,
+                           chunksize=None):
+        """Uncached implementation of generate_odmatrix."""
+        if approximate and not 0 < error < 1:
+            raise SakayDBError
 
         # Check if date range tuple items are greater than 2
         if len(date_range) > 2:
@@ -940,88 +3278,152 @@ class SakayDB():
         else:
             pass
 
-        # Set date format
-        format = '%H:%M:%S,%d-%m-%Y'
-
-        # Check if date format is correct
-        try:
-            if (date_range[0] is None) & (date_range[1] is not None):
-                datetime.strptime(date_range[1], format)
-            elif (date_range[0] is not None) & (date_range[1] is None):
-                datetime.strptime(date_range[0], format)
-            elif (date_range[0] is not None) & (date_range[1] is not None):
-                datetime.strptime(date_range[0], format)
-                datetime.strptime(date_range[1], format)
-            else:
-                pass
-        except ValueError:
+        # Check if date format is correct and convert date_range to
+        # datetime to set interval
+        min_date, max_date = [None if date is None
+                              else _parse_datetime(date)
+                              for date in date_range[:2]]
+        if min_date is pd.NaT or max_date is pd.NaT:
             raise SakayDBError('Invalid date range.')
 
-        # Get file path of trips and locations csv files
-        trips_path = self.data_dir + '/trips.csv'
-        locations_path = self.data_dir + '/locations.csv'
-
         # Check if trips.csv exists in the directory
-        try:
-            f = open(trips_path)
-        except IOError:
+        if not self._exists('trips.csv'):
             return pd.DataFrame({'A': []})
 
-        # Read trips.csv file and store to a df
-        trips = pd.read_csv(trips_path)
-        locations = pd.read_csv(locations_path)
-
-        # Convert str date to datetime
-        format = '%H:%M:%S,%d-%m-%Y'
-        trips['pickup_datetime'] = pd.to_datetime(trips['pickup_datetime'],
-                                                  format=format)
-        trips['dropoff_datetime'] = pd.to_datetime(trips['dropoff_datetime'],
-                                                   format=format)
+        if approximate:
+            return self._approximate_odmatrix(min_date, max_date, error)
+        if window is not None:
+            return self._window_odmatrix(*window)
+        if self._store is not None:
+            return self._sqlite_odmatrix(min_date, max_date)
+        if chunksize is not None:
+            return self._chunked_odmatrix(min_date, max_date, chunksize)
 
-        # Convert date_range to datetime then to set interval
-        min_date = pd.to_datetime(date_range[0], format=format)
-        max_date = pd.to_datetime(date_range[1], format=format)
+        # Read trips.csv file and store to a df
+        trips = self._read_trips(usecols=['pickup_datetime',
+                                          'dropoff_datetime',
+                                          'pickup_loc_id',
+                                          'dropoff_loc_id'])
+        locations = self._read_locations()
 
         # Filter rows that are not within date_range
-        if (max_date is None) & (min_date is not None):
-            trips = trips.loc[trips['pickup_datetime'] >= min_date]
-        elif (min_date is None) & (max_date is not None):
-            trips = trips.loc[trips['pickup_datetime'] <= min_date]
-        elif (min_date is None) & (max_date is None):
-            trips = trips
-        else:
-            trips = trips.loc[(trips['pickup_datetime'] >= min_date) &
-                              (trips['dropoff_datetime'] <= max_date)]
-
-        # Add column to count the unique dropoff-pickup combinations
-        trips['unique_droppick'] = 1.0
-
-        # Replace pickup loc id with pickup loc name
-        loc_df = locations.rename(columns={'location_id': 'pickup_loc_id'})
-        trips = (trips.merge(loc_df, how='left', on='pickup_loc_id')
-                 .rename(columns={'loc_name': 'pickup_loc_name'}))
-
-        # Replace dropoff loc id with dropoff up loc name
-        loc_df = locations.rename(columns={'location_id': 'dropoff_loc_id'})
-        trips = (trips.merge(loc_df, how='left', on='dropoff_loc_id')
-                 .rename(columns={'loc_name': 'dropoff_loc_name'}))
-
-        # Drop loc_id columns
-        trips.drop(['pickup_loc_id', 'dropoff_loc_id'], axis=1, inplace=True)
+        if (min_date is not None) | (max_date is not None):
+            trips = trips.loc[self._date_range_mask(trips, min_date,
+                                                    max_date)]
+
+        # Replace loc ids with categorical loc names, so that each
+        # name is stored once instead of once per trip
+        names = locations.set_index('location_id')['loc_name']
+        trips = pd.DataFrame({
+            'dropoff_loc_name': _as_category(trips['dropoff_loc_id'], names),
+            'pickup_loc_name': _as_category(trips['pickup_loc_id'], names),
+            'pickup_datetime': trips['pickup_datetime'].dt.floor('D')
+        })
 
         # Get the number of daily trips for each
         # unique dropoff-pickup location combinations
         trips = (trips.groupby(['dropoff_loc_name', 'pickup_loc_name',
-                                pd.Grouper(key='pickup_datetime',
-                                           freq='1D')])
-                 ['unique_droppick'].sum().reset_index())
+                                'pickup_datetime'], observed=True)
+                 .size())
 
         # Get the average daily trips for each dropoff-pickup combinations
-        trips = (trips.groupby(['dropoff_loc_name', 'pickup_loc_name'])
-                 ['unique_droppick'].mean().reset_index())
+        trips = trips.groupby(level=['dropoff_loc_name', 'pickup_loc_name'],
+                              observed=True).mean()
+
+        return self._od_pivot(trips)
+
+    @staticmethod
+    def _date_range_mask(trips, min_date, max_date):
+        """Rows of trips that are within the date_range passed to
+        generate_odmatrix."""
+        if (max_date is None) & (min_date is not None):
+            return trips['pickup_datetime'] >= min_date
+        elif (min_date is None) & (max_date is not None):
+            return trips['pickup_datetime'] <= max_date
+        elif (min_date is None) & (max_date is None):
+            return pd.Series(True, index=trips.index)
+        else:
+            return ((trips['pickup_datetime'] >= min_date) &
+                    (trips['dropoff_datetime'] <= max_date))
+
+    @staticmethod
+    def _od_pivot(trips):
+        """Creates the matrix from a series indexed by dropoff and
+        pickup location names."""
+        trips = trips.rename('unique_droppick').reset_index()
+        trips['dropoff_loc_name'] = trips['dropoff_loc_name'].astype(object)
+        trips['pickup_loc_name'] = trips['pickup_loc_name'].astype(object)
 
-        # Create the matrix
         final_df = (trips.pivot(index='dropoff_loc_name',
                                 columns='pickup_loc_name',
                                 values='unique_droppick').fillna(0))
         return final_df
+
+    def _window_odmatrix(self, length, end):
+        """Computes generate_odmatrix over a window of days."""
+        means = self._window(length, end).means('od')
+        return self._od_by_ids([pu for pu, do in means],
+                               [do for pu, do in means],
+                               list(means.values()))
+
+    def _od_by_ids(self, pickup_loc_ids, dropoff_loc_ids, values):
+        """Creates the matrix from values keyed by location ids."""
+        names = self._read_locations().set_index('location_id')['loc_name']
+        index = pd.MultiIndex.from_arrays(
+            [names.reindex(dropoff_loc_ids).values,
+             names.reindex(pickup_loc_ids).values],
+            names=['dropoff_loc_name', 'pickup_loc_name'])
+        return self._od_pivot(pd.Series(values, index=index, dtype=float))
+
+    def _chunked_odmatrix(self, min_date, max_date, chunksize):
+        """Computes generate_odmatrix from daily counts of each pair
+        summed over chunks of trips.csv."""
+        location_ids = self._read_locations()['location_id']
+        counts = _ChunkCounts(['od'])
+        for trips in self._trip_chunks(['pickup_datetime',
+                                        'dropoff_datetime',
+                                        'pickup_loc_id',
+                                        'dropoff_loc_id'], chunksize):
+            keep = (self._date_range_mask(trips, min_date, max_date) &
+                    trips['pickup_loc_id'].isin(location_ids) &
+                    trips['dropoff_loc_id'].isin(location_ids))
+            counts.add(trips.loc[keep])
+        means = counts.counts['od'].groupby(
+            level=['pickup_loc_id', 'dropoff_loc_id']).mean()
+        return self._od_by_ids(means.index.get_level_values(0),
+                               means.index.get_level_values(1),
+                               means.values)
+
+    def _sqlite_odmatrix(self, min_date, max_date):
+        """Computes generate_odmatrix as a GROUP BY in sqlite."""
+        where = []
+        params = []
+        if min_date is not None:
+            where.append('pickup_datetime >= ?')
+            params.append(min_date.strftime(ISO_FORMAT))
+        if max_date is not None:
+            where.append('dropoff_datetime <= ?' if min_date is not None
+                         else 'pickup_datetime <= ?')
+            params.append(max_date.strftime(ISO_FORMAT))
+        means = self._store.od_means(where, params)
+        return self._od_by_ids(means['pickup_loc_id'].values,
+                               means['dropoff_loc_id'].values,
+                               means['mean'].values)
+
+    def _approximate_odmatrix(self, min_date, max_date, error):
+        """Estimates generate_odmatrix from the day sample."""
+        sample = self._day_sample(error)
+        trips = sample.sample
+        names = self._read_locations().set_index('location_id')['loc_name']
+        rows = self._date_range_mask(trips, min_date, max_date).values
+        days = sample.daily_estimates({}, rows)
+        totals = {0: days['est'].values}
+        sampled = {0: ~days['whole'].values}
+        daily = sample.daily_estimates({
+            'dropoff_loc_name': _as_category(trips['dropoff_loc_id'], names),
+            'pickup_loc_name': _as_category(trips['pickup_loc_id'], names)
+        }, rows)
+        mean, bound = _mean_estimates(daily, ['dropoff_loc_name',
+                                              'pickup_loc_name'],
+                                      totals, sampled)
+        return self._od_pivot(mean), self._od_pivot(bound)
@@ -0,0 +1,228 @@
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sakaydb import (SakayDB, SakayDBError, DATETIME_FORMAT,
+                     TRIP_BAD_DRIVER, TRIP_DUPLICATE, TRIP_OK)
+
+
+TRIP = {'driver': 'Lim, Ben',
+        'pickup_datetime': '10:00:00,02-01-2022',
+        'dropoff_datetime': '11:00:00,02-01-2022',
+        'passenger_count': 1,
+        'pickup_loc_name': 'Makati',
+        'dropoff_loc_name': 'Pasig',
+        'trip_distance': 10,
+        'fare_amount': 20.25}
+
+
+def test_add_trips_codes(tmp_path):
+    db = SakayDB(str(tmp_path))
+    ids, codes = db.add_trips([TRIP, dict(TRIP, driver=', Ben'), TRIP],
+                              return_codes=True)
+    assert ids == [1]
+    assert codes.tolist() == [TRIP_OK, TRIP_BAD_DRIVER, TRIP_DUPLICATE]
+
+
+def test_add_trips_large_passenger_count(tmp_path):
+    # No upper bound: counts past the compact schema are stored as is
+    db = SakayDB(str(tmp_path))
+    ids, codes = db.add_trips([dict(TRIP, passenger_count=1000)],
+                              return_codes=True)
+    assert codes.tolist() == [TRIP_OK]
+    assert ids == [1]
+    found = db.search_trips(driver_id=1)
+    assert found['passenger_count'].tolist() == [1000]
+
+
+def test_add_trips_all_bad_names(tmp_path):
+    db = SakayDB(str(tmp_path))
+    # None of the names splits in two
+    trips = [dict(TRIP, driver=driver)
+             for driver in ['Nocomma', 'Lim,Ben', '']]
+    ids, codes = db.add_trips(trips, return_codes=True)
+    assert ids == []
+    assert np.all(codes == TRIP_BAD_DRIVER)
+
+
+def test_add_trip_keeps_counts_outside_compact_schema(tmp_path):
+    db = SakayDB(str(tmp_path))
+    db.add_trip(**dict(TRIP, passenger_count=300))
+    db.add_trip(**dict(TRIP, passenger_count=2.5, fare_amount=1))
+    db.add_trip(**dict(TRIP, fare_amount=2))
+    found = db.search_trips(driver_id=1)
+    assert found['passenger_count'].tolist() == [300, 2.5, 1]
+    db.delete_trip(1)
+    found = db.search_trips(driver_id=1)
+    assert found['passenger_count'].tolist() == [2.5, 1]
+
+
+def write_tables(data_dir, trips=200, seed=0):
+    """Writes small drivers, locations and trips csvs to data_dir."""
+    rng = np.random.default_rng(seed)
+    pd.DataFrame({'driver_id': [1, 2, 3, 4],
+                  'given_name': ['Ana', 'Ben', 'Carla', 'Dan'],
+                  'last_name': ['Cruz', 'Lim', 'Sy', 'Uy']}).to_csv(
+        os.path.join(data_dir, 'drivers.csv'), index=False)
+    pd.DataFrame({'location_id': [1, 2, 3],
+                  'loc_name': ['Makati', 'Pasig', 'Taguig']}).to_csv(
+        os.path.join(data_dir, 'locations.csv'), index=False)
+    pickup = (pd.Timestamp('2022-01-03')
+              + pd.to_timedelta(rng.integers(0, 20 * 86400, trips), 's'))
+    dropoff = pickup + pd.to_timedelta(rng.integers(600, 3600, trips), 's')
+    pd.DataFrame({
+        'trip_id': np.arange(1, trips + 1),
+        'driver_id': rng.integers(1, 5, trips),
+        'pickup_datetime': pickup.strftime(DATETIME_FORMAT),
+        'dropoff_datetime': dropoff.strftime(DATETIME_FORMAT),
+        'passenger_count': rng.integers(1, 5, trips),
+        'pickup_loc_id': rng.integers(1, 4, trips),
+        'dropoff_loc_id': rng.integers(1, 4, trips),
+        'trip_distance': rng.integers(1000, 20000, trips),
+        'fare_amount': rng.integers(4000, 30000, trips) / 100}).to_csv(
+        os.path.join(data_dir, 'trips.csv'), index=False)
+
+
+def test_sqlite_matches_csv(tmp_path):
+    write_tables(str(tmp_path))
+    csv = SakayDB(str(tmp_path))
+    sql = SakayDB(str(tmp_path), backend='sqlite')
+
+    expected = csv.generate_statistics('all')
+    result = sql.generate_statistics('all')
+    assert result['trip'] == pytest.approx(expected['trip'])
+    for stat in ['passenger', 'driver']:
+        pd.testing.assert_frame_equal(pd.DataFrame(expected[stat]),
+                                      pd.DataFrame(result[stat]))
+    for date_range in [(None, None), ('00:00:00,10-01-2022', None),
+                       (None, '00:00:00,10-01-2022')]:
+        pd.testing.assert_frame_equal(csv.generate_odmatrix(date_range),
+                                      sql.generate_odmatrix(date_range),
+                                      check_dtype=False)
+    for kwargs in [{'driver_id': 2}, {'fare_amount': (100, 200)},
+                   {'passenger_count': (2, 3), 'trip_distance': (None, 9000)},
+                   {'pickup_datetime': ('00:00:00,05-01-2022',
+                                        '00:00:00,08-01-2022')}]:
+        pd.testing.assert_frame_equal(
+            csv.search_trips(**kwargs).reset_index(drop=True),
+            sql.search_trips(**kwargs).reset_index(drop=True),
+            check_dtype=False)
+    pd.testing.assert_frame_equal(
+        csv.export_data().reset_index(drop=True),
+        sql.export_data().reset_index(drop=True), check_dtype=False)
+
+
+def test_sqlite_import_leaves_out_unknown_drivers(tmp_path):
+    write_tables(str(tmp_path), trips=10)
+    trips = pd.read_csv(tmp_path / 'trips.csv')
+    trips.loc[0, 'driver_id'] = 99
+    trips.to_csv(tmp_path / 'trips.csv', index=False)
+
+    db = SakayDB(str(tmp_path), backend='sqlite')
+    assert len(db.export_data()) == 9
+    assert len(SakayDB(str(tmp_path)).export_data()) == 9
+
+
+def test_sqlite_failed_import_leaves_no_database(tmp_path):
+    write_tables(str(tmp_path), trips=10)
+    trips = pd.read_csv(tmp_path / 'trips.csv')
+    trips.loc[1, 'trip_id'] = 1
+    trips.to_csv(tmp_path / 'trips.csv', index=False)
+
+    for _ in range(2):
+        with pytest.raises(sqlite3.IntegrityError):
+            SakayDB(str(tmp_path), backend='sqlite')
+        assert not os.path.exists(tmp_path / 'sakaydb.db')
+
+
+def test_odmatrix_open_start_matches_across_backends(tmp_path):
+    write_tables(str(tmp_path))
+    date_range = (None, '00:00:00,10-01-2022')
+    expected = SakayDB(str(tmp_path)).generate_odmatrix(date_range)
+    assert expected.values.sum() > 0
+    pd.testing.assert_frame_equal(
+        SakayDB(str(tmp_path)).generate_odmatrix(date_range, chunksize=7),
+        expected, check_dtype=False)
+    pd.testing.assert_frame_equal(
+        SakayDB(str(tmp_path), backend='sqlite').generate_odmatrix(
+            date_range), expected, check_dtype=False)
+
+
+def test_approximate_matches_exact_when_days_kept_whole(tmp_path):
+    # About 15 trips a day, well under the sample size of error=0.05
+    write_tables(str(tmp_path), trips=300)
+    db = SakayDB(str(tmp_path))
+    for stat in ['passenger', 'driver']:
+        expected = pd.DataFrame(db.generate_statistics(stat))
+        result, bounds = db.generate_statistics(stat, approximate=True)
+        pd.testing.assert_frame_equal(
+            pd.DataFrame(result).reindex_like(expected), expected)
+        assert np.nanmax(pd.DataFrame(bounds).values) == 0
+    expected = db.generate_odmatrix()
+    result, bounds = db.generate_odmatrix(approximate=True)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    assert bounds.values.max() == 0
+
+
+def test_search_cache_keeps_filter_order(tmp_path):
+    write_tables(str(tmp_path))
+    db = SakayDB(str(tmp_path))
+    ranges = {'fare_amount': (100, 200), 'trip_distance': (5000, 15000)}
+    by_distance = db.search_trips(**ranges)
+    by_fare = db.search_trips(**dict(reversed(list(ranges.items()))))
+    assert by_distance['trip_distance'].is_monotonic_increasing
+    assert by_fare['fare_amount'].is_monotonic_increasing
+    assert not by_fare['trip_distance'].is_monotonic_increasing
+
+
+def test_top_drivers_counts_shared_names_as_one(tmp_path):
+    write_tables(str(tmp_path))
+    drivers = pd.read_csv(tmp_path / 'drivers.csv')
+    drivers.loc[3, ['given_name', 'last_name']] = ['Ben', 'Lim']
+    drivers.to_csv(tmp_path / 'drivers.csv', index=False)
+    db = SakayDB(str(tmp_path))
+
+    expected = db.generate_statistics('driver')
+    top = db.top_drivers(k=10)
+    for w, means in top.items():
+        assert means == pytest.approx(
+            {name: expected[name][w] for name in means})
+    assert db.top_drivers(k=10, by='all', metric='trips') == {
+        'Lim, Ben': 105, 'Sy, Carla': 49, 'Cruz, Ana': 46}
+
+
+def test_import_file_rejects_what_validate_trips_rejects(tmp_path):
+    bad = [dict(TRIP, driver=', Ben'), dict(TRIP, trip_distance=-1),
+           dict(TRIP, fare_amount=-1), dict(TRIP, passenger_count=-1),
+           dict(TRIP, dropoff_datetime='09:00:00,02-01-2022'),
+           dict(TRIP, pickup_loc_name='  ')]
+    db = SakayDB(str(tmp_path))
+    assert np.all(db.validate_trips(bad + [TRIP])[:-1] != TRIP_OK)
+    path = tmp_path / 'import.csv'
+    pd.DataFrame(bad + [TRIP]).to_csv(path, index=False)
+    assert db.import_file(str(path)) == 1
+    assert db.export_data()['fare_amount'].tolist() == [20.25]
+
+
+def test_search_trips_unknown_cursor(tmp_path):
+    write_tables(str(tmp_path))
+    csv = SakayDB(str(tmp_path))
+    sql = SakayDB(str(tmp_path), backend='sqlite')
+    csv.delete_trip(5)
+    sql.delete_trip(5)
+
+    def check(db, **kwargs):
+        assert len(db.search_trips(limit=3, after=4, **kwargs)) == 3
+        for after in [5, 999]:
+            with pytest.raises(SakayDBError):
+                db.search_trips(limit=3, after=after, **kwargs)
+
+    for db in [csv, sql]:
+        check(db, driver_id=2)
+        check(db, fare_amount=(100, 200))
+    # Sliced rather than scanned in trip_id order
+    with csv.batch():
+        check(csv, driver_id=2)